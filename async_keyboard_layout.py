@@ -1,4 +1,7 @@
 import asyncio
+import time
+from collections import deque
+from contextlib import aclosing
 
 async def await_and_print(c):
     print(await c)
@@ -22,30 +25,128 @@ async def available_keyboard_layouts(xkblayout_state_bin:str|None=None) -> list[
     await p.wait()
     return (await p.communicate())[0].decode().strip().split("\n")
 
-async def layout_status(xkblayout_state_bin:str|None=None, xkblayout_sub_bin:str|None=None, layouts_display={"ru":"🇷🇺", "us":"🇺🇸"}):
+class ProcessSupervisor:
+    """
+    Keeps a helper binary running and hands out its stdout lines.
+
+    When the child exits it is restarted after an exponential backoff
+    (`min_backoff` doubling up to `max_backoff`, reset once a child stayed up for
+    `stable_after` seconds). If it has to be restarted more than `restart_budget`
+    times within `budget_period` seconds the supervisor gives up, so a missing or
+    crashing binary doesn't turn into a busy loop.
+    """
+    def __init__(self, *cmd:str, min_backoff:float=0.5, max_backoff:float=60.0, stable_after:float=10.0, restart_budget:int=5, budget_period:float=60.0):
+        self.cmd = cmd
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.stable_after = stable_after
+        self.restart_budget = restart_budget
+        self.budget_period = budget_period
+
+        self.process:asyncio.subprocess.Process|None = None
+        self.restarts = 0
+        self.last_exit_code:int|None = None
+        self.last_error:str|None = None
+        self.started_at:float|None = None
+        self.given_up = False
+        self._failures = 0
+        self._restart_times:deque[float] = deque()
+
+    @property
+    def uptime(self) -> float:
+        if self.started_at is None or self.process is None or self.process.returncode is not None:
+            return 0.0
+        return time.monotonic() - self.started_at
+
+    def info(self) -> dict:
+        return {
+            "cmd": " ".join(self.cmd),
+            "running": self.uptime > 0,
+            "pid": self.process.pid if self.process else None,
+            "restarts": self.restarts,
+            "last_exit_code": self.last_exit_code,
+            "last_error": self.last_error,
+            "uptime": self.uptime,
+            "given_up": self.given_up,
+        }
+
+    async def _spawn(self) -> bool:
+        try:
+            self.process = await asyncio.create_subprocess_exec(*self.cmd, stdout=asyncio.subprocess.PIPE)
+        except OSError as err:
+            self.process = None
+            self.last_error = str(err)
+            return False
+        self.started_at = time.monotonic()
+        return True
+
+    async def _backoff(self) -> bool:
+        """
+        Wait before the next restart. Returns False when the restart budget is spent.
+        """
+        now = time.monotonic()
+        ran_for = now - self.started_at if self.started_at is not None else 0.0
+        self._failures = 1 if ran_for >= self.stable_after else self._failures + 1
+
+        self._restart_times.append(now)
+        while self._restart_times and now - self._restart_times[0] > self.budget_period:
+            self._restart_times.popleft()
+        if len(self._restart_times) > self.restart_budget:
+            self.given_up = True
+            return False
+
+        delay = min(self.min_backoff * 2 ** (self._failures - 1), self.max_backoff)
+        await asyncio.sleep(delay)
+        self.restarts += 1
+        return True
+
+    async def lines(self):
+        """
+        Yield stdout lines of the helper, restarting it as needed, until the restart
+        budget is exhausted.
+        """
+        try:
+            while not self.given_up:
+                if self.process is None or self.process.returncode is not None:
+                    if not await self._spawn():
+                        if not await self._backoff():
+                            break
+                        continue
+
+                line = await self.process.stdout.readline()
+                if line:
+                    yield line.decode().strip()
+                    continue
+
+                self.last_exit_code = await self.process.wait()
+                if not await self._backoff():
+                    break
+            if self.given_up:
+                raise RuntimeError(f"{self.cmd[0]} keeps failing, giving up: {self.info()}")
+        finally:
+            await self.stop()
+
+    async def stop(self):
+        if self.process is not None and self.process.returncode is None:
+            self.process.kill()
+            self.last_exit_code = await self.process.wait()
+
+
+async def layout_status(xkblayout_state_bin:str|None=None, xkblayout_sub_bin:str|None=None, layouts_display={"ru":"🇷🇺", "us":"🇺🇸"}, supervisor:ProcessSupervisor|None=None):
     if xkblayout_sub_bin is None:
         xkblayout_sub_bin = "xkblayout-subscribe"
+    if supervisor is None:
+        supervisor = ProcessSupervisor(xkblayout_sub_bin)
     keyboard_layouts = await available_keyboard_layouts(xkblayout_state_bin)
     state = await get_current_keyboard_state(xkblayout_state_bin)
     yield layouts_display.get(keyboard_layouts[state],keyboard_layouts[state])
-    p = await asyncio.create_subprocess_exec(xkblayout_sub_bin, stdout=asyncio.subprocess.PIPE)
-    while True:
-        if p.returncode is not None:
-            await p.communicate()
-            await p.wait()
-            del p
-            p = await asyncio.create_subprocess_exec(xkblayout_sub_bin, stdout=asyncio.subprocess.PIPE)
-
-        if p.stdout is None: continue
-
-        state = (await p.stdout.readline()).decode().strip()
-        if state == '' or p.stdout.at_eof():
-            _ = await p.wait() 
-            continue
-        else:
-            state = int(state)
-        yield layouts_display.get(keyboard_layouts[state],keyboard_layouts[state])
-
+    # closed with us, so the supervised process is stopped then and not by the GC
+    async with aclosing(supervisor.lines()) as lines:
+        async for line in lines:
+            if not line:
+                continue
+            state = int(line)
+            yield layouts_display.get(keyboard_layouts[state],keyboard_layouts[state])
 
 if __name__ == "__main__":
     asyncio.run(await_and_print(available_keyboard_layouts()))
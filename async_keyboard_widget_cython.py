@@ -6,8 +6,14 @@ import importlib
 
 import asyncio
 import concurrent.futures
+from collections import OrderedDict
 from typing import Callable, Any
-from multiprocessing import Process, Value
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import Connection
+
+import async_keyboard_layout
+from timing import log_duration
+from xkb_layout import XkbState
 
 # from xkblayout_module_wrapper import update as layout_update
 
@@ -22,22 +28,87 @@ def ignore_exceptions(func:Callable):
     return wrapper
 
 
-def get_update(num):
+def get_update(pipe):
     # print(f"entered `get_update`")
     xkbls = importlib.import_module("xkblayout_subscribe")
     xkbls.init()
     while True:
-        value = xkbls.update()
-        with num.get_lock():
-            # print(f"value is: {value}")
-            num.value=value
-            # print("set the value")
+        # only a change wakes the parent, there is nothing to poll on its side
+        pipe.send(xkbls.update())
     xkbls.deinit()
     # print("exit")
 
 
+class WindowLayoutMemory:
+    """
+    Remembers the keyboard group of every window and restores it on focus.
+
+    Groups are switched with XKB requests on qtile's connection, so a focus change
+    costs one request at most and nothing when the layout is already right. Entries
+    are dropped when windows are killed, and the least recently focused ones are
+    evicted past `max_windows`.
+    """
+    def __init__(self, xkb:XkbState, max_windows:int=256, default_group:int|None=None):
+        self.xkb = xkb
+        self.max_windows = max_windows
+        self.default_group = default_group
+        self._groups:OrderedDict[int, int] = OrderedDict()
+        self._focused:int|None = None
+
+    def subscribe(self):
+        hook.subscribe.client_focus(self.on_focus)
+        hook.subscribe.client_killed(self.on_killed)
+        self.xkb.subscribe(self.on_group)
+
+    def unsubscribe(self):
+        hook.unsubscribe.client_focus(self.on_focus)
+        hook.unsubscribe.client_killed(self.on_killed)
+        self.xkb.unsubscribe(self.on_group)
+
+    def _remember(self, wid:int, group:int):
+        self._groups[wid] = group
+        self._groups.move_to_end(wid)
+        while len(self._groups) > self.max_windows:
+            self._groups.popitem(last=False)
+
+    def on_focus(self, window):
+        self._focused = window.wid
+        group = self._groups.get(window.wid, self.default_group)
+        if group is None:
+            group = self.xkb.group
+        self._remember(window.wid, group)
+        if group != self.xkb.group:
+            self.xkb.lock_group(group)
+
+    def on_group(self, group:int):
+        if self._focused is not None:
+            self._remember(self._focused, group)
+
+    def on_killed(self, window):
+        self._groups.pop(window.wid, None)
+        if self._focused == window.wid:
+            self._focused = None
+
+
 class KeyboardLayoutAsync(base.ThreadPoolText):
+    """
+    Display keyboard layout the moment it changes!
+
+    With the default "xkb" backend the widget listens to XKB state notifications on
+    qtile's own X connection and needs no helper binaries. The "process" backend uses
+    the `xkblayout_subscribe` extension; it is also used as a fallback when XKB is not
+    available (e.g. on Wayland).
+
+    If the extension provides `fileno()` and a non-blocking `read_event()` it is driven
+    in-process from the event loop. Older builds only have a blocking `update()`, so it
+    runs in a child process that sends every change down a pipe the event loop watches.
+    Either way the widget only wakes up when the layout actually changes.
+    """
     defaults = [
+        ("backend", "xkb", "How to watch the layout: 'xkb' (in-process) or 'process'."),
+        ("deferred_init", True, "Paint a placeholder and query layouts in the background instead of blocking startup."),
+        ("per_window", False, "Remember the layout of each window and restore it on focus. Needs the 'xkb' backend."),
+        ("per_window_default", None, "Layout index for newly focused windows, or None to keep the current one."),
         ("xkblayout_state_bin", "xkblayout-state", "path to the xkblayout-state binary, provide it when binary not in PATH"),
         ("display_map", None,
         "Custom display of layout. Key should be in format "
@@ -49,51 +120,148 @@ class KeyboardLayoutAsync(base.ThreadPoolText):
     qtile: Qtile
     future:asyncio.Future
     process:Process|None = None
-    num = None
+    _pipe:Connection|None = None
+    _xkbls = None
+    _reader_fd:int|None = None
+    _group:int = 0
+    _xkb:XkbState|None = None
+    _window_memory:WindowLayoutMemory|None = None
+    _refresh_task:asyncio.Task|None = None
+    _init_task:asyncio.Task|None = None
+    _display_cache:list[str]|None = None
     
 
     def __init__(self, **config):
         super().__init__("□", **config)
         logger.warn(f"{type(self).__name__} Initinalized!")
         self.add_defaults(KeyboardLayoutAsync.defaults)
-        self.update_interval = 0
+        self.update_interval = None
+        if self.display_map is None:
+            self.display_map = {}
 
     def update_available_keyboard_layouts(self,xkblayout_state_bin:str|None=None):
         self.keyboard_layouts = self.call_process(f"{self.xkblayout_state_bin} print %S", shell=True).strip().split("\n")
+        self._display_cache = None
+
+    async def _refresh_keyboard_layouts(self):
+        try:
+            self.keyboard_layouts = await async_keyboard_layout.available_keyboard_layouts(self.xkblayout_state_bin)
+            self._display_cache = None
+            logger.info(f"Updated keyboard layouts! {self.keyboard_layouts = }")
+            self.update(self._display(self._group))
+        except Exception:
+            logger.exception("couldn't update available keyboard layouts")
+        finally:
+            self._refresh_task = None
     
     def get_current_layout_state(self,xkblayout_state_bin:str|None=None):
-        current_state = int(self.call_process(f"{self.xkblayout_state_bin} print %c", shell=True).strip())
-        self.update(self.display_map.get(self.keyboard_layouts[current_state], self.keyboard_layouts[current_state]))
+        self._group = int(self.call_process(f"{self.xkblayout_state_bin} print %c", shell=True).strip())
+        self.update(self._display(self._group))
+
+    async def _init_process_backend(self):
+        try:
+            with log_duration(f"{self.name} (process backend)"):
+                self.keyboard_layouts = await async_keyboard_layout.available_keyboard_layouts(self.xkblayout_state_bin)
+                self._display_cache = None
+                self._group = await async_keyboard_layout.get_current_keyboard_state(self.xkblayout_state_bin)
+                self.update(self._display(self._group))
+                self._start_listener()
+        except Exception:
+            logger.exception("couldn't start the keyboard layout listener")
+        finally:
+            self._init_task = None
 
     
-    def poll(self):
-        # loop = asyncio.get_running_loop()
-        # with councurrent.futures.ProcessPoolExecutor() as pool:
+    def _display(self, layout_index:int) -> str:
+        if self._xkb is not None:
+            layouts = self._xkb.layouts()
+            if layouts is not self.keyboard_layouts:
+                self.keyboard_layouts = layouts
+                self._display_cache = None
+        if self._display_cache is None:
+            self._display_cache = [self.display_map.get(layout, layout) for layout in self.keyboard_layouts]
+        try:
+            return self._display_cache[layout_index]
+        except IndexError:
+            return str(layout_index)
 
-        if not self.num and not self.process:
-            self.num = Value("I", 0)
-            self.process = Process(target=get_update, args=(self.num,))
-            self.process.start()
+    def _on_xkb_group(self, group:int):
+        self._group = group
+        self.update(self._display(group))
+
+    def _on_layout_index(self, updated_value:int):
+        self._group = updated_value
+        if updated_value >= len(self.keyboard_layouts) and self._refresh_task is None:
+            # show the bare index until the new list arrives instead of blocking here
+            logger.info(f"Index error! Updating available keyboard layouts! right now they are: {self.keyboard_layouts = }")
+            self._refresh_task = asyncio.create_task(self._refresh_keyboard_layouts())
+        self.update(self._display(updated_value))
 
-        with self.num.get_lock():
-            updated_value = int(self.num.value)
+    def _on_extension_readable(self):
+        value = None
+        while (event := self._xkbls.read_event()) is not None:
+            value = event
+        if value is not None:
+            self._on_layout_index(int(value))
 
+    def _on_pipe_readable(self):
+        value = None
         try:
-            new_state = self.keyboard_layouts[updated_value]
-        except IndexError:
-            logger.info(f"Index error! Updating available keyboard layouts! right now they are: {self.keyboard_layouts = }")
-            self.update_available_keyboard_layouts()
-            logger.info(f"Updated keyboard layouts! {self.keyboard_layouts = }")
-            new_state = self.keyboard_layouts[updated_value]
-        return self.display_map.get(new_state, new_state)
-    
+            while self._pipe.poll():
+                value = self._pipe.recv()
+        except EOFError:
+            logger.warning("xkblayout_subscribe child process exited")
+            self._remove_reader()
+        if value is not None:
+            self._on_layout_index(int(value))
+
+    def _start_listener(self):
+        xkbls = importlib.import_module("xkblayout_subscribe")
+        if hasattr(xkbls, "fileno") and hasattr(xkbls, "read_event"):
+            xkbls.init()
+            self._xkbls = xkbls
+            self._reader_fd = xkbls.fileno()
+            callback = self._on_extension_readable
+        else:
+            self._pipe, child_end = Pipe(duplex=False)
+            self.process = Process(target=get_update, args=(child_end,), daemon=True)
+            self.process.start()
+            child_end.close()
+            self._reader_fd = self._pipe.fileno()
+            callback = self._on_pipe_readable
+        asyncio.get_running_loop().add_reader(self._reader_fd, callback)
+
+    def _remove_reader(self):
+        if self._reader_fd is not None:
+            asyncio.get_running_loop().remove_reader(self._reader_fd)
+            self._reader_fd = None
+
+    def timer_setup(self):
+        # updates are pushed from the event loop, nothing to poll
+        pass
+
+    def poll(self):
+        return self._display(self._group)
+
     # def init_xkbls(self):
     #     if xkbls.init():
     #         raise RuntimeError("couldn't run the `init` function for `xkbls`")
     
     def process_kill(self):
+        self._remove_reader()
+        if self._refresh_task:
+            self._refresh_task.cancel()
+        if self._init_task:
+            self._init_task.cancel()
+        if self._xkbls:
+            self._xkbls.deinit()
+            self._xkbls = None
         if self.process:
             self.process.kill()
+            self.process = None
+        if self._pipe:
+            self._pipe.close()
+            self._pipe = None
     
     def _setup_hooks(self):
         pass
@@ -104,7 +272,36 @@ class KeyboardLayoutAsync(base.ThreadPoolText):
 
     def _configure(self, qtile:Qtile, bar):
         super()._configure(qtile, bar)
-        self.update_available_keyboard_layouts()
-        self.get_current_layout_state()
+        if self.backend == "xkb":
+            try:
+                self._xkb = XkbState.get(qtile)
+            except Exception:
+                logger.exception("XKB is not available, falling back to the process backend")
+        if self._xkb is not None:
+            with log_duration(f"{self.name} (xkb backend)"):
+                self._xkb.subscribe(self._on_xkb_group)
+                self.update(self._display(self._xkb.current_group()))
+            if self.per_window and self._window_memory is None:
+                self._window_memory = WindowLayoutMemory(self._xkb, default_group=self.per_window_default)
+                self._window_memory.subscribe()
+            return
+        if self.per_window:
+            logger.warning("per_window layouts need the 'xkb' backend, ignoring")
         self._setup_hooks()
+        if self.deferred_init:
+            if self._init_task is None:
+                self._init_task = asyncio.create_task(self._init_process_backend())
+            return
+        with log_duration(f"{self.name} (process backend)"):
+            self.update_available_keyboard_layouts()
+            self.get_current_layout_state()
+            self._start_listener()
+
+    def finalize(self):
+        if self._xkb is not None:
+            self._xkb.unsubscribe(self._on_xkb_group)
+        if self._window_memory is not None:
+            self._window_memory.unsubscribe()
+        self.process_kill()
+        super().finalize()
 
@@ -0,0 +1,20 @@
+"""
+Nearest-rank percentiles shared by the benchmarks, as used by the Notifier's stats.
+Unlike statistics.quantiles, they never extrapolate past the largest sample.
+"""
+
+from __future__ import annotations
+
+from math import ceil
+
+
+def percentiles(samples: list[float], *ps: float) -> list[float]:
+    """
+    The samples at each of the fractions `ps`, e.g. percentiles(s, 0.5, 0.99), or
+    an empty list if there are no samples.
+    """
+    ordered = sorted(samples)
+    if not ordered:
+        return []
+    # Rounded first so that e.g. 0.07 * 100 doesn't come out just above 7
+    return [ordered[max(0, ceil(round(p * len(ordered), 9)) - 1)] for p in ps]
@@ -0,0 +1,305 @@
+"""
+Latency benchmark for the keyboard layout backends.
+
+Drives layout switches through each backend and reports switch-to-`update()` latency
+percentiles, idle CPU, RSS overhead and the number of extra processes.
+
+Backends:
+
+    layout_status   async_keyboard_layout.layout_status
+    async_widget    async_keyboard_widget.KeyboardLayoutAsync
+    process         async_keyboard_widget_cython.KeyboardLayoutAsync, backend="process"
+    xkb             async_keyboard_widget_cython.KeyboardLayoutAsync, backend="xkb"
+
+The first three are fed by stand-ins for xkblayout-state, xkblayout-subscribe and the
+xkblayout_subscribe extension that read switches from a FIFO, so they need no X
+server. The xkb backend needs a real one with at least two groups and no window
+manager, since it drives qtile's own X11 core, e.g.:
+
+    Xvfb :99 & DISPLAY=:99 setxkbmap us,ru
+    DISPLAY=:99 python benchmarks/keyboard_layout.py --backend xkb
+
+Usage:
+
+    python benchmarks/keyboard_layout.py [--backend NAME ...] [--switches N] [--idle S]
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import psutil
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+from _percentiles import percentiles  # noqa: E402
+
+LAYOUTS = ["us", "ru"]
+
+FAKE_STATE = """#!{python}
+import sys
+print("\\n".join({layouts!r}) if sys.argv[2] == "%S" else 0)
+"""
+
+FAKE_SUBSCRIBE = """#!{python}
+with open({fifo!r}) as f:
+    for line in f:
+        print(line.strip(), flush=True)
+"""
+
+FAKE_EXTENSION = """
+_f = None
+def init():
+    global _f
+    _f = open({fifo!r})
+def update():
+    return int(_f.readline())
+def deinit():
+    _f.close()
+"""
+
+
+class StandIns:
+    """
+    Fake helpers in a temporary directory, all fed from one FIFO.
+    """
+
+    def __init__(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        path = Path(self.dir.name)
+        self.fifo = str(path / "switches")
+        os.mkfifo(self.fifo)
+        self.state_bin = self._script(path / "xkblayout-state", FAKE_STATE)
+        self.subscribe_bin = self._script(path / "xkblayout-subscribe", FAKE_SUBSCRIBE)
+        (path / "xkblayout_subscribe.py").write_text(FAKE_EXTENSION.format(fifo=self.fifo))
+        sys.path.insert(0, self.dir.name)
+        os.environ["PYTHONPATH"] = os.pathsep.join([self.dir.name, *sys.path])
+        # O_RDWR so opening doesn't wait for a reader to show up
+        self._writer = os.open(self.fifo, os.O_RDWR)
+
+    def _script(self, path: Path, template: str) -> str:
+        path.write_text(
+            template.format(python=sys.executable, layouts=LAYOUTS, fifo=self.fifo)
+        )
+        path.chmod(0o755)
+        return str(path)
+
+    def current_group(self) -> int:
+        return 0
+
+    def switch(self, group: int) -> None:
+        os.write(self._writer, f"{group}\n".encode())
+
+    def close(self) -> None:
+        os.close(self._writer)
+        sys.path.remove(self.dir.name)
+        self.dir.cleanup()
+
+
+class Recorder:
+    """
+    Collects the time between a switch being triggered and `update()` being called.
+    """
+
+    def __init__(self) -> None:
+        self.latencies: list[float] = []
+        self._sent: float | None = None
+        self._event = asyncio.Event()
+
+    def sent(self) -> None:
+        self._event.clear()
+        self._sent = time.perf_counter()
+
+    def update(self, text: str) -> None:
+        if self._sent is not None:
+            self.latencies.append(time.perf_counter() - self._sent)
+            self._sent = None
+        self._event.set()
+
+    async def wait(self, timeout: float = 2.0) -> None:
+        await asyncio.wait_for(self._event.wait(), timeout)
+
+
+def _cpu_seconds(proc: psutil.Process) -> float:
+    total = sum(proc.cpu_times()[:2])
+    for child in proc.children(recursive=True):
+        try:
+            total += sum(child.cpu_times()[:2])
+        except psutil.NoSuchProcess:
+            pass
+    return total
+
+
+def _rss(proc: psutil.Process) -> int:
+    total = proc.memory_info().rss
+    for child in proc.children(recursive=True):
+        try:
+            total += child.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return total
+
+
+async def _start_layout_status(stand_ins: StandIns, recorder: Recorder):
+    import async_keyboard_layout
+
+    async def consume():
+        async for text in async_keyboard_layout.layout_status(
+            stand_ins.state_bin, stand_ins.subscribe_bin, {}
+        ):
+            recorder.update(text)
+
+    task = asyncio.create_task(consume())
+    return task.cancel
+
+
+async def _start_async_widget(stand_ins: StandIns, recorder: Recorder):
+    from async_keyboard_widget import KeyboardLayoutAsync
+
+    widget = KeyboardLayoutAsync(
+        xkblayout_state_bin=stand_ins.state_bin,
+        xkblayout_subscribe_bin=stand_ins.subscribe_bin,
+    )
+    widget.update = recorder.update
+    widget._task = asyncio.create_task(widget._read_from_generator())
+    return widget._on_restart
+
+
+async def _start_process(stand_ins: StandIns, recorder: Recorder):
+    from async_keyboard_widget_cython import KeyboardLayoutAsync
+
+    widget = KeyboardLayoutAsync(backend="process")
+    widget.keyboard_layouts = LAYOUTS
+    widget.update = recorder.update
+    widget._start_listener()
+    return widget.process_kill
+
+
+async def _start_xkb(stand_ins: StandIns, recorder: Recorder):
+    import xcffib.xkb
+    from libqtile.backend.x11.core import Core
+
+    from async_keyboard_widget_cython import KeyboardLayoutAsync
+    from xkb_layout import XkbState
+
+    # qtile's real X11 core, so events go through its own dispatch. It takes over
+    # the root window like a window manager, so the display must not have one.
+    core = Core(os.environ["DISPLAY"])
+    core.qtile = SimpleNamespace(core=core, windows_map={})
+    conn = core.conn
+    xkb = XkbState.get(core.qtile)
+
+    loop = asyncio.get_running_loop()
+    loop.add_reader(conn.conn.get_file_descriptor(), core._xpoll)
+
+    widget = KeyboardLayoutAsync(backend="xkb")
+    widget._xkb = xkb
+    widget.update = recorder.update
+    xkb.subscribe(widget._on_xkb_group)
+
+    def switch(group: int) -> None:
+        xkb.xkb.LatchLockState(
+            xcffib.xkb.ID.UseCoreKbd, 0, 0, True, group, 0, False, 0
+        )
+        conn.conn.flush()
+
+    stand_ins.switch = switch
+    stand_ins.current_group = xkb.current_group
+
+    def stop():
+        loop.remove_reader(conn.conn.get_file_descriptor())
+        conn.finalize()
+
+    return stop
+
+
+BACKENDS = {
+    "layout_status": _start_layout_status,
+    "async_widget": _start_async_widget,
+    "process": _start_process,
+    "xkb": _start_xkb,
+}
+
+
+async def run_backend(name: str, switches: int, idle: float) -> dict:
+    proc = psutil.Process()
+    stand_ins = StandIns()
+    recorder = Recorder()
+    rss_before = _rss(proc)
+    children_before = len(proc.children(recursive=True))
+    try:
+        stop = await BACKENDS[name](stand_ins, recorder)
+        # the initial state, and give helpers time to start
+        await asyncio.sleep(0.5)
+
+        # Locking the group that is already active sends no event, so every switch
+        # has to move away from the current one
+        first = stand_ins.current_group() + 1
+        for i in range(switches):
+            recorder.sent()
+            stand_ins.switch((first + i) % len(LAYOUTS))
+            await recorder.wait()
+
+        cpu_before = _cpu_seconds(proc)
+        await asyncio.sleep(idle)
+        idle_cpu = (_cpu_seconds(proc) - cpu_before) / idle
+
+        result = {
+            "backend": name,
+            "latencies": recorder.latencies,
+            "idle_cpu": idle_cpu,
+            "rss": _rss(proc) - rss_before,
+            "processes": len(proc.children(recursive=True)) - children_before,
+        }
+        stop()
+        await asyncio.sleep(0.1)
+        return result
+    finally:
+        stand_ins.close()
+
+
+def report(result: dict) -> str:
+    lat = result["latencies"]
+    if not lat:
+        return f"{result['backend']:<14} no switches recorded"
+    p50, p90, p99 = percentiles(lat, 0.5, 0.9, 0.99)
+    return (
+        f"{result['backend']:<14} "
+        f"p50 {p50 * 1e3:7.3f}ms  p90 {p90 * 1e3:7.3f}ms  "
+        f"p99 {p99 * 1e3:7.3f}ms  max {max(lat) * 1e3:7.3f}ms  "
+        f"idle cpu {result['idle_cpu'] * 100:5.2f}%  "
+        f"rss +{result['rss'] / 2**20:6.1f}MiB  "
+        f"procs +{result['processes']}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--backend",
+        action="append",
+        choices=BACKENDS,
+        help="Backend to run, may be repeated. Default: all that can run here.",
+    )
+    parser.add_argument("--switches", type=int, default=200)
+    parser.add_argument("--idle", type=float, default=5.0, help="Idle CPU window (s).")
+    args = parser.parse_args()
+
+    backends = args.backend
+    if not backends:
+        backends = [b for b in BACKENDS if b != "xkb" or os.environ.get("DISPLAY")]
+
+    for name in backends:
+        result = asyncio.run(run_backend(name, args.switches, args.idle))
+        print(report(result), flush=True)
+
+
+if __name__ == "__main__":
+    main()
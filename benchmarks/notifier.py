@@ -0,0 +1,511 @@
+"""
+Stress and throughput benchmark for graphical_notifications.Notifier.
+
+Drives a Notifier through realistic mixes of traffic and reports notifications per
+second, per-call latency percentiles and memory growth. Popups draw into offscreen
+cairo surfaces instead of X windows and notifications are delivered by a stand-in for
+libqtile.notify.notifier, so no display or session bus is needed. qtile, cairocffi and
+pango still have to be installed.
+
+Scenarios:
+
+    burst       a few apps sending back-to-back, enough to hit the rate limit
+    replace     progress notifications updated in place through replaces_id
+    critical    normal traffic with critical notifications interleaved
+    icons       every notification with an icon, from more files than are cached
+    browse      prev/next through the history, and pausing and resuming
+
+Usage:
+
+    python benchmarks/notifier.py [--scenario NAME ...] [--count N] [--max-windows N]
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+from types import SimpleNamespace
+
+import cairocffi
+import psutil
+from libqtile import pangocffi
+from libqtile.popup import Popup
+from libqtile.utils import rgb
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+import graphical_notifications  # noqa: E402
+from _percentiles import percentiles  # noqa: E402
+
+try:
+    from dbus_next import Variant
+    from libqtile.notify import Notification
+except ImportError:  # no dbus_next
+
+    class Variant:  # type: ignore
+        def __init__(self, signature: str, value) -> None:
+            self.signature = signature
+            self.value = value
+
+    class Notification:  # type: ignore
+        def __init__(
+            self,
+            summary,
+            body="",
+            timeout=-1,
+            hints=None,
+            app_name="",
+            replaces_id=None,
+            app_icon=None,
+            actions=None,
+        ) -> None:
+            self.summary = summary
+            self.body = body
+            self.timeout = timeout
+            self.hints = hints or {}
+            self.app_name = app_name
+            self.replaces_id = replaces_id
+            self.app_icon = app_icon
+            self.actions = actions
+            self.id = None
+
+    # Used by Notifier when it coalesces notifications
+    import libqtile.notify
+
+    libqtile.notify.Notification = Notification
+
+BODY = (
+    "The quick brown fox jumps over the lazy dog, then does it again because "
+    "notifications are rarely as short as they should be."
+)
+
+
+class FakeQtile:
+    """
+    The parts of qtile the Notifier uses, with a single 1920x1080 screen.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+        self.current_window = None
+        self.current_screen = SimpleNamespace(x=0, y=0, width=1920, height=1080)
+        self.screens = [self.current_screen]
+        self.mouse_position = (0, 0)
+
+    def find_screen(self, x: int, y: int):
+        return self.current_screen
+
+    def call_later(self, delay: float, func, *args):
+        return self.loop.call_later(delay, func, *args)
+
+    def run_in_executor(self, func, *args):
+        return self.loop.run_in_executor(None, func, *args)
+
+
+class StandInNotifier:
+    """
+    Local replacement for libqtile.notify.notifier. Ids are handed out like libqtile
+    does, from the length of the notification list.
+    """
+
+    def __init__(self) -> None:
+        self.notifications: list = []
+        self.callbacks: list = []
+        self.close_callbacks: list = []
+        self.closed = 0
+        self._service = SimpleNamespace(
+            NotificationClosed=self._closed, ActionInvoked=lambda nid, key: None
+        )
+
+    def _closed(self, nid: int, reason: int) -> None:
+        self.closed += 1
+
+    async def register(self, callback, capabilities=None, on_close=None) -> None:
+        self.callbacks.append(callback)
+        if on_close is not None:
+            self.close_callbacks.append(on_close)
+
+    def add(self, notif) -> int:
+        self.notifications.append(notif)
+        notif.id = len(self.notifications)
+        for callback in self.callbacks:
+            callback(notif)
+        return notif.id
+
+    def close(self, nid: int) -> None:
+        for callback in self.close_callbacks:
+            callback(nid)
+
+
+class FakeLayout:
+    """
+    Pango layout standing in for libqtile.drawer.TextLayout.
+    """
+
+    def __init__(self, font: str, font_size: float) -> None:
+        surface = cairocffi.ImageSurface(cairocffi.FORMAT_ARGB32, 1, 1)
+        ctx = pangocffi.patch_cairo_context(cairocffi.Context(surface))
+        self.layout = ctx.create_layout()
+        desc = pangocffi.FontDescription.from_string(font)
+        desc.set_absolute_size(pangocffi.units_from_double(float(font_size)))
+        self.layout.set_font_description(desc)
+        self._width = -1
+
+    @property
+    def width(self) -> float:
+        return self._width
+
+    @width.setter
+    def width(self, value: float) -> None:
+        self._width = value
+        self.layout.set_width(pangocffi.units_from_double(value))
+
+    @property
+    def height(self) -> int:
+        return self.layout.get_pixel_size()[1]
+
+    def set_markup(self, markup: str) -> None:
+        attrs, text, _ = pangocffi.parse_markup(markup)
+        self.layout.set_attributes(attrs)
+        self.layout.set_text(text)
+
+
+class FakeDrawer:
+    """
+    Offscreen surface in place of a window's drawer. It is recreated when the
+    popup's size changes, as libqtile's drawer does.
+    """
+
+    def __init__(self, width: int, height: int) -> None:
+        self.width = width
+        self.height = height
+        self._size = None
+        self._resize()
+
+    def _resize(self) -> None:
+        if self._size != (self.width, self.height):
+            self._size = (self.width, self.height)
+            self.surface = cairocffi.ImageSurface(
+                cairocffi.FORMAT_ARGB32, self.width, self.height
+            )
+            self.ctx = pangocffi.patch_cairo_context(cairocffi.Context(self.surface))
+
+    def set_source_rgb(self, colour: str) -> None:
+        self.ctx.set_source_rgba(*rgb(colour))
+
+    def clear(self, colour: str) -> None:
+        self._resize()
+        self.set_source_rgb(colour)
+        self.ctx.paint()
+
+    def draw(self, **kwargs) -> None:
+        FakePopup.calls["draw"] += 1
+
+
+class FakePopup:
+    """
+    libqtile.popup.Popup drawing offscreen. Text and images are really rendered, so
+    drawing costs are close to those of real windows; only the X requests are left
+    out, and counted instead.
+    """
+
+    defaults = Popup.defaults
+    calls: Counter = Counter()
+
+    def __init__(self, qtile, x=50, y=50, width=256, height=64, **config) -> None:
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.horizontal_padding = config.get("horizontal_padding", 0)
+        self.background = config.get("background", "#111111")
+        self.foreground = config.get("foreground", "#ffffff")
+        self.drawer = FakeDrawer(width, height)
+        self.layout = FakeLayout(config.get("font", "sans"), config.get("font_size", 14))
+        self.win = SimpleNamespace()
+        self.calls["create"] += 1
+
+    @property
+    def text(self) -> str:
+        return self._text
+
+    @text.setter
+    def text(self, value: str) -> None:
+        self._text = value
+        self.layout.set_markup(value)
+
+    def clear(self) -> None:
+        self.drawer.clear(self.background)
+
+    def draw_text(self, x=None, y=None) -> None:
+        ctx = self.drawer.ctx
+        ctx.set_source_rgba(*rgb(self.foreground))
+        ctx.move_to(self.horizontal_padding if x is None else x, y or 0)
+        ctx.show_layout(self.layout.layout)
+
+    def draw_image(self, image, x, y) -> None:
+        self.drawer.ctx.set_source_surface(image, x, y)
+        self.drawer.ctx.paint()
+
+    def draw(self) -> None:
+        self.drawer.draw()
+
+    def set_border(self, colour) -> None:
+        pass
+
+    def place(self) -> None:
+        self.calls["place"] += 1
+
+    def unhide(self) -> None:
+        self.calls["unhide"] += 1
+
+    def hide(self) -> None:
+        self.calls["hide"] += 1
+
+    def kill(self) -> None:
+        self.calls["kill"] += 1
+
+
+class Bench:
+    """
+    Runs calls into a Notifier, timing each of them by operation.
+    """
+
+    def __init__(self, notifier, stand_in: StandInNotifier, icons: list[str]) -> None:
+        self.notifier = notifier
+        self.stand_in = stand_in
+        self.icons = icons
+        self.latencies: dict[str, list[float]] = {}
+        self.sent = 0
+
+    def _timed(self, op: str, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        self.latencies.setdefault(op, []).append(time.perf_counter() - start)
+        return result
+
+    def notify(
+        self,
+        summary: str,
+        body: str = BODY,
+        app_name: str = "bench",
+        urgency: int = 1,
+        value: int | None = None,
+        icon: str | None = None,
+        replaces_id: int | None = None,
+    ) -> int:
+        hints = {"urgency": Variant("y", urgency)}
+        if value is not None:
+            hints["value"] = Variant("i", value)
+        notif = Notification(
+            summary, body, -1, hints, app_name, replaces_id, icon, ["default", "Open"]
+        )
+        self.sent += 1
+        return self._timed("notify", self.stand_in.add, notif)
+
+    def close(self) -> None:
+        self._timed("close", self.notifier.close)
+
+    def close_id(self, nid: int) -> None:
+        self._timed("close_id", self.stand_in.close, nid)
+
+    def prev(self) -> None:
+        self._timed("prev", self.notifier.prev)
+
+    def next(self) -> None:
+        self._timed("next", self.notifier.next)
+
+    def pause(self) -> None:
+        self._timed("pause", self.notifier.pause)
+
+    async def tick(self) -> None:
+        # Let timers and icon decoding run
+        await asyncio.sleep(0)
+
+
+async def burst(bench: Bench, count: int) -> None:
+    for i in range(count):
+        bench.notify(f"Message {i}", app_name=f"app{i // 50 % 4}")
+        if i % 4 == 3:
+            bench.close()
+        await bench.tick()
+
+
+async def replace(bench: Bench, count: int) -> None:
+    ids = [
+        bench.notify(f"file{j}.iso", "Copying", app_name="transfer", value=0)
+        for j in range(3)
+    ]
+    for i in range(count):
+        j = i % len(ids)
+        # Mostly only the bar changes, sometimes the text too
+        body = "Copying" if i % 10 else f"Copying, {count - i} left"
+        ids[j] = bench.notify(
+            f"file{j}.iso",
+            body,
+            app_name="transfer",
+            value=i % 101,
+            replaces_id=ids[j],
+        )
+        await bench.tick()
+
+
+async def critical(bench: Bench, count: int) -> None:
+    for i in range(count):
+        if i % 8 == 7:
+            nid = bench.notify(f"Battery at {i % 10}%", app_name="power", urgency=2)
+            bench.close_id(nid)
+        else:
+            bench.notify(f"Message {i}", app_name=f"app{i % 5}", urgency=i % 2)
+        if i % 3 == 2:
+            bench.close()
+        await bench.tick()
+
+
+async def icons(bench: Bench, count: int) -> None:
+    for i in range(count):
+        icon = bench.icons[i % len(bench.icons)]
+        bench.notify(f"Message {i}", app_name=f"app{i % 7}", icon=icon)
+        if i % 2:
+            bench.close()
+        await bench.tick()
+
+
+async def browse(bench: Bench, count: int) -> None:
+    for i in range(min(count, 200)):
+        bench.notify(f"Message {i}", app_name=f"app{i % 7}")
+        await bench.tick()
+    bench.notifier.close_all()
+    for i in range(count):
+        if i % 50 < 25:
+            bench.prev()
+        else:
+            bench.next()
+        if i % 100 == 99:
+            bench.close()
+            bench.pause()
+            bench.notify(f"While paused {i}")
+            bench.pause()
+        await bench.tick()
+
+
+SCENARIOS = {
+    "burst": burst,
+    "replace": replace,
+    "critical": critical,
+    "icons": icons,
+    "browse": browse,
+}
+
+
+def make_icons(directory: Path, count: int, size: int = 64) -> list[str]:
+    paths = []
+    for i in range(count):
+        surface = cairocffi.ImageSurface(cairocffi.FORMAT_ARGB32, size, size)
+        ctx = cairocffi.Context(surface)
+        ctx.set_source_rgb(i % 3 / 2, i % 5 / 4, i % 7 / 6)
+        ctx.paint()
+        path = str(directory / f"icon{i}.png")
+        surface.write_to_png(path)
+        paths.append(path)
+    return paths
+
+
+async def run_scenario(name: str, count: int, config: dict, icon_count: int) -> dict:
+    loop = asyncio.get_running_loop()
+    stand_in = StandInNotifier()
+    graphical_notifications.qtile = FakeQtile(loop)
+    graphical_notifications.notifier = stand_in
+    graphical_notifications.Popup = FakePopup
+    FakePopup.calls.clear()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        icon_paths = make_icons(Path(tmp), icon_count)
+        history = str(Path(tmp) / "history.log") if config.pop("history") else False
+        notifier = graphical_notifications.Notifier(history=history, **config)
+        await notifier._configure()
+        bench = Bench(notifier, stand_in, icon_paths)
+
+        proc = psutil.Process()
+        rss_before = proc.memory_info().rss
+        start = time.perf_counter()
+        await SCENARIOS[name](bench, count)
+        elapsed = time.perf_counter() - start
+
+        # Coalesced notifications are still due, and icons may still be decoding
+        await asyncio.sleep(notifier.coalesce_window / 1000 + 0.1)
+        notifier.close_all()
+        rss = proc.memory_info().rss - rss_before
+
+        stats = notifier.stats()
+        if notifier._history is not stand_in.notifications:
+            notifier._history.close()
+
+    return {
+        "scenario": name,
+        "sent": bench.sent,
+        "elapsed": elapsed,
+        "latencies": bench.latencies,
+        "paint": stats["receive_to_paint_ms"],
+        "counters": {k: v for k, v in stats.items() if isinstance(v, int)},
+        "calls": dict(FakePopup.calls),
+        "rss": rss,
+    }
+
+
+def report(result: dict) -> str:
+    paint = result["paint"]
+    lines = [
+        f"{result['scenario']:<9} "
+        f"{result['sent'] / result['elapsed']:9.0f} notifs/s  "
+        f"receive->paint p50 {paint.get('p50', 0):7.3f}ms  "
+        f"p99 {paint.get('p99', 0):7.3f}ms  "
+        f"rss +{result['rss'] / 2**20:6.1f}MiB"
+    ]
+    for op, samples in sorted(result["latencies"].items()):
+        p50, p90, p99 = percentiles(samples, 0.5, 0.9, 0.99)
+        lines.append(
+            f"  {op:<9} n {len(samples):6}  "
+            f"p50 {p50 * 1e3:7.3f}ms  p90 {p90 * 1e3:7.3f}ms  "
+            f"p99 {p99 * 1e3:7.3f}ms  max {max(samples) * 1e3:7.3f}ms"
+        )
+    counters = ", ".join(f"{k} {v}" for k, v in result["counters"].items())
+    calls = ", ".join(f"{k} {v}" for k, v in sorted(result["calls"].items()))
+    lines.append(f"  {counters}")
+    lines.append(f"  popup calls: {calls}")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=SCENARIOS,
+        help="Scenario to run, may be repeated. Default: all.",
+    )
+    parser.add_argument("--count", type=int, default=2000, help="Calls per scenario.")
+    parser.add_argument("--max-windows", type=int, default=2)
+    parser.add_argument(
+        "--icons", type=int, default=96, help="Number of distinct icon files."
+    )
+    parser.add_argument(
+        "--history-on-disk",
+        action="store_true",
+        help="Keep the history in a NotificationHistory file instead of in memory.",
+    )
+    args = parser.parse_args()
+
+    for name in args.scenario or SCENARIOS:
+        config = {"max_windows": args.max_windows, "history": args.history_on_disk}
+        result = asyncio.run(run_scenario(name, args.count, config, args.icons))
+        print(report(result), flush=True)
+
+
+if __name__ == "__main__":
+    main()
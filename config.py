@@ -32,6 +32,7 @@ from pathlib import Path
 from textwrap import shorten
 from typing import Callable, List, Optional
 
+from timing import since_config_load
 from async_keyboard_widget_cython import KeyboardLayoutAsync
 from bindings import keys, mod, terminal
 from graphical_notifications import Notifier
@@ -105,6 +106,11 @@ if not XEPHYR:
                 subprocess.Popen([autostart_file_path], stdout=output, stderr=output)
 
 
+@hook.subscribe.startup_complete
+def log_startup_time():
+    logger.info(f"Bar usable {since_config_load() * 1000:.1f} ms after config load")
+
+
 # @hook.subscribe.focus_change
 # @hook.subscribe.client_new
 @hook.subscribe.client_managed
@@ -434,12 +440,10 @@ keys.extend(
 )
 
 
-# TODO: make height and width set programmatically
-HEIGHT = 768
-WIDTH = 1366
 notifier = Notifier(
+    corner="top_right",
     y=10,
-    x=WIDTH - 310,
+    x=10,
     width=300,
     height=69,
     format="<b>{summary}</b>\n{body}",
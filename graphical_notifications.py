@@ -18,23 +18,40 @@ Usage:
         Key(['control'],    'space', lazy.function(notifier.close)),
     ])
 
+Config code can show notifications without going through D-Bus:
+
+    async def show_volume(volume):
+        global volume_id
+        volume_id = await notifier.show("Volume", value=volume, replaces_id=volume_id)
+
 Qtile versions known to work: 0.17 - 0.18
 """
 
 from __future__ import annotations
 
 import asyncio
-from textwrap import wrap
+import heapq
+import itertools
+import math
+import threading
+import time
+from collections import OrderedDict, deque
 from typing import TYPE_CHECKING
 
-from libqtile import configurable, hook, images, pangocffi, qtile
+import cairocffi
+from libqtile import configurable, hook, images, pangocffi, qtile, utils
+from libqtile.command.base import expose_command
 from libqtile.lazy import lazy
 from libqtile.log_utils import logger
 from libqtile.notify import ClosedReason, notifier
 from libqtile.popup import Popup
+from libqtile.widget import base
+
+from notification_history import NotificationHistory, SearchIndex
+from timing import log_duration
 
 if TYPE_CHECKING:
-    from typing import Any, Callable, Dict, List, Optional, Tuple
+    from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
 
     from cairocffi import ImageSurface
     from libqtile.core.manager import Qtile
@@ -45,6 +62,373 @@ if TYPE_CHECKING:
         Notification = Any  # type: ignore
 
 
+def _urgency(notif: Notification) -> int:
+    if "urgency" in notif.hints:
+        return notif.hints["urgency"].value
+    return 1
+
+
+def _progress(notif: Notification) -> Optional[int]:
+    if "value" in notif.hints:
+        return max(0, min(100, notif.hints["value"].value))
+    return None
+
+
+def _same_apart_from_progress(old: Notification, new: Notification) -> bool:
+    return (
+        _progress(old) is not None
+        and _progress(new) is not None
+        and old.summary == new.summary
+        and old.body == new.body
+        and old.app_name == new.app_name
+        and old.app_icon == new.app_icon
+        and _urgency(old) == _urgency(new)
+    )
+
+
+class _NotificationQueue:
+    """
+    Notifications waiting to be shown, most urgent first and then in order of
+    arrival. `on_wait` is called with the seconds each one spent in the queue. How
+    many are waiting from each app_name is counted, so `take` can skip apps that
+    have none.
+    """
+
+    def __init__(self, on_wait: Optional[Callable[[float], Any]] = None) -> None:
+        self._heap: List[Tuple[int, int, float, Notification]] = []
+        self._counter: Iterator[int] = itertools.count()
+        self._apps: Dict[str, int] = {}
+        self.on_wait = on_wait
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def __bool__(self) -> bool:
+        return bool(self._heap)
+
+    def push(self, notif: Notification) -> None:
+        heapq.heappush(
+            self._heap,
+            (-_urgency(notif), next(self._counter), time.monotonic(), notif),
+        )
+        app = notif.app_name or ""
+        self._apps[app] = self._apps.get(app, 0) + 1
+
+    def _removed(self, notif: Notification) -> None:
+        app = notif.app_name or ""
+        if self._apps[app] == 1:
+            del self._apps[app]
+        else:
+            self._apps[app] -= 1
+
+    def _waited(self, queued_at: float, now: float) -> None:
+        if self.on_wait is not None:
+            self.on_wait(now - queued_at)
+
+    def pop(self) -> Notification:
+        _, _, queued_at, notif = heapq.heappop(self._heap)
+        self._waited(queued_at, time.monotonic())
+        self._removed(notif)
+        return notif
+
+    def clear(self) -> None:
+        self._heap.clear()
+        self._apps.clear()
+
+    def take(
+        self, app_name: str, match: Callable[[Notification], bool]
+    ) -> List[Notification]:
+        """
+        Remove the notifications from `app_name` for which `match` is true, returning
+        them in the order they would have been popped.
+        """
+        if not self._apps.get(app_name or ""):
+            return []
+        now = time.monotonic()
+        taken = []
+        kept = []
+        for item in sorted(self._heap, key=lambda i: i[:2]):
+            if (item[3].app_name or "") == (app_name or "") and match(item[3]):
+                self._waited(item[2], now)
+                self._removed(item[3])
+                taken.append(item[3])
+            else:
+                kept.append(item)
+        if taken:
+            # Sorted, so already a valid heap
+            self._heap = kept
+        return taken
+
+    def drain(self) -> List[Notification]:
+        """
+        Empty the queue, returning its contents in the order they would be popped.
+        """
+        now = time.monotonic()
+        items = []
+        for _, _, queued_at, notif in sorted(self._heap, key=lambda i: i[:2]):
+            self._waited(queued_at, now)
+            items.append(notif)
+        self._heap.clear()
+        self._apps.clear()
+        return items
+
+
+class _Expiry:
+    """
+    Deadlines after which popups are closed. However many popups are shown, a single
+    loop timer is armed, for the nearest deadline. Deadlines can be moved, cancelled,
+    and paused and resumed with the time that was left.
+    """
+
+    def __init__(self, callback: Callable[[Popup], Any]) -> None:
+        self.callback = callback
+        self._deadlines: Dict[Popup, float] = {}
+        self._paused: Dict[Popup, float] = {}
+        self._heap: List[Tuple[float, int, Popup]] = []
+        self._counter: Iterator[int] = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timer_at: Optional[float] = None
+
+    def schedule(self, popup: Popup, seconds: float) -> None:
+        self._paused.pop(popup, None)
+        deadline = time.monotonic() + seconds
+        self._deadlines[popup] = deadline
+        heapq.heappush(self._heap, (deadline, next(self._counter), popup))
+        self._arm()
+
+    def cancel(self, popup: Popup) -> None:
+        self._paused.pop(popup, None)
+        # Its heap entry is skipped when it comes up
+        if self._deadlines.pop(popup, None) is not None:
+            self._arm()
+
+    def pause(self, popup: Popup) -> None:
+        deadline = self._deadlines.pop(popup, None)
+        if deadline is not None:
+            self._paused[popup] = max(0, deadline - time.monotonic())
+            self._arm()
+
+    def resume(self, popup: Popup) -> None:
+        remaining = self._paused.pop(popup, None)
+        if remaining is not None:
+            self.schedule(popup, remaining)
+
+    def pause_all(self) -> None:
+        for popup in list(self._deadlines):
+            self.pause(popup)
+
+    def resume_all(self) -> None:
+        for popup in list(self._paused):
+            self.resume(popup)
+
+    def _nearest(self) -> Optional[float]:
+        while self._heap:
+            deadline, _, popup = self._heap[0]
+            if self._deadlines.get(popup) == deadline:
+                return deadline
+            heapq.heappop(self._heap)
+        return None
+
+    def _arm(self) -> None:
+        nearest = self._nearest()
+        if nearest == self._timer_at:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._timer_at = nearest
+        if nearest is not None:
+            self._timer = qtile.call_later(
+                max(0, nearest - time.monotonic()), self._fire
+            )
+
+    def _fire(self) -> None:
+        self._timer = None
+        self._timer_at = None
+        now = time.monotonic()
+        try:
+            while (deadline := self._nearest()) is not None and deadline <= now:
+                _, _, popup = heapq.heappop(self._heap)
+                del self._deadlines[popup]
+                try:
+                    self.callback(popup)
+                except Exception:
+                    logger.exception("Error closing expired notification")
+        finally:
+            self._arm()
+
+
+def _percentiles(samples: Deque[float]) -> Dict[str, Any]:
+    """
+    Summary of a buffer of durations, in milliseconds.
+    """
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def rank(p: float) -> float:
+        # Nearest rank, rounded first so that e.g. 0.07 * 100 doesn't exceed 7
+        n = max(0, math.ceil(round(p * len(ordered), 9)) - 1)
+        return round(ordered[n] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "p50": rank(0.5),
+        "p90": rank(0.9),
+        "p99": rank(0.99),
+        "max": round(ordered[-1] * 1000, 3),
+    }
+
+
+class _Stats:
+    """
+    Recent timings and running counters of a Notifier. Timings are kept in ring
+    buffers of `size` samples so they cost a fixed amount of memory.
+    """
+
+    def __init__(self, size: int) -> None:
+        self.latency: Deque[float] = deque(maxlen=size)
+        self.queued: Deque[float] = deque(maxlen=size)
+        self.icon_load: Deque[float] = deque(maxlen=size)
+        self.queue_depth: Deque[int] = deque(maxlen=size)
+        self.counters: Dict[str, int] = dict.fromkeys(
+            (
+                "received",
+                "shown",
+                "queued",
+                "coalesced",
+                "stacked",
+                "preempted",
+                "icon_failures",
+            ),
+            0,
+        )
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] += n
+
+    def summary(self) -> Dict[str, Any]:
+        depths = list(self.queue_depth)
+        return {
+            "receive_to_paint_ms": _percentiles(self.latency),
+            "queued_ms": _percentiles(self.queued),
+            "icon_load_ms": _percentiles(self.icon_load),
+            "queue_depth": {
+                "current": depths[-1] if depths else 0,
+                "max": max(depths, default=0),
+                "mean": round(sum(depths) / len(depths), 2) if depths else 0,
+            },
+            **self.counters,
+        }
+
+
+class _LRUCache:
+    """
+    Mapping that forgets its least recently used entries once it holds more than
+    `max_items` entries or, if `sizeof` is given, more than `max_bytes` in total.
+    """
+
+    def __init__(
+        self,
+        max_items: int,
+        max_bytes: Optional[int] = None,
+        sizeof: Optional[Callable[[Any], int]] = None,
+    ) -> None:
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self._data: OrderedDict[Any, Any] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self._data
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        if key not in self._data:
+            return default
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def put(self, key: Any, value: Any) -> None:
+        self.pop(key)
+        self._data[key] = value
+        if self.sizeof:
+            self.bytes += self.sizeof(value)
+        while len(self._data) > self.max_items or (
+            self.max_bytes is not None and self.bytes > self.max_bytes and len(self._data) > 1
+        ):
+            self.pop(next(iter(self._data)))
+
+    def pop(self, key: Any) -> Any:
+        value = self._data.pop(key, None)
+        if value is not None and self.sizeof:
+            self.bytes -= self.sizeof(value)
+        return value
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.bytes = 0
+
+
+def _surface_bytes(surface: ImageSurface) -> int:
+    return surface.get_stride() * surface.get_height()
+
+
+def _icon_bytes(icon: Tuple[ImageSurface, int]) -> int:
+    return _surface_bytes(icon[0])
+
+
+class _TextMetrics:
+    """
+    Pixel sizes of Pango markup in one font and size. Results are cached, so the same
+    string is only laid out once.
+    """
+
+    def __init__(self, font: str, font_size: float, cache_size: int = 512) -> None:
+        self._surface = cairocffi.ImageSurface(cairocffi.FORMAT_ARGB32, 1, 1)
+        self._ctx = pangocffi.patch_cairo_context(cairocffi.Context(self._surface))
+        self._layout = self._ctx.create_layout()
+        desc = pangocffi.FontDescription.from_string(font)
+        desc.set_absolute_size(pangocffi.units_from_double(float(font_size)))
+        self._layout.set_font_description(desc)
+        self._sizes = _LRUCache(cache_size)
+
+    def size(self, markup: str, width: Optional[float] = None) -> Tuple[int, int]:
+        """
+        Width and height of the markup, wrapped at `width` pixels if given.
+        """
+        key = (markup, width)
+        size = self._sizes.get(key)
+        if size is None:
+            attrs, text, _ = pangocffi.parse_markup(markup)
+            self._layout.set_attributes(attrs)
+            self._layout.set_text(text)
+            self._layout.set_width(
+                -1 if width is None else pangocffi.units_from_double(width)
+            )
+            size = self._layout.get_pixel_size()
+            self._sizes.put(key, size)
+        return size
+
+
+# Kept per thread, as notifications are fitted on worker threads and a Pango layout
+# can only be used by one of them at a time
+_metrics = threading.local()
+
+
+def _text_metrics(font: str, font_size: float) -> _TextMetrics:
+    cache = getattr(_metrics, "cache", None)
+    if cache is None:
+        cache = _metrics.cache = {}
+    key = (font, font_size)
+    if key not in cache:
+        cache[key] = _TextMetrics(font, font_size)
+    return cache[key]
+
+
 class Notifier(configurable.Configurable):
     """
     This class provides a full graphical notification manager for the
@@ -62,20 +446,48 @@ class Notifier(configurable.Configurable):
     The max_windows option limits how many popup windows can be drawn at a time. When
     more notifications are recieved while the maximum number are already drawn,
     notifications are queued and displayed when existing notifications are closed.
+    Popup windows are only created when needed, and unused ones are destroyed again
+    after popup_idle_release seconds.
+    Queued notifications are shown most urgent first. A critical notification that
+    arrives while all windows are in use takes over the window of the least urgent
+    visible notification, which goes back into the queue.
+
+    The rate_limit option caps how many notifications a single app_name can show per
+    second. Anything over the limit is collected for coalesce_window milliseconds and
+    then shown as one popup using coalesce_format, whose placeholders are count,
+    app_name and summary (of the latest notification). Every notification is still
+    kept in the history. Critical notifications and replacements of an existing
+    notification are never held back.
+
+    With stack enabled, a notification from an app that already has a popup on
+    screen is added to that popup instead of taking another window or waiting in the
+    queue. The popup shows the latest notification with its summary formatted by
+    stack_format (placeholders as for coalesce_format), and closing it closes all of
+    them. Critical notifications and those with a progress bar are never stacked.
+
+    A progress bar is drawn along the bottom of notifications with the int:value hint
+    (0 - 100). When a notification is replaced by one that only differs in that value,
+    only the bar is repainted.
+
+    Text that doesn't fit is handled according to the overflow option, measured in
+    pixels: truncate shortens the body with an ellipsis, more_height and more_width
+    grow the popup (up to the screen size, truncating what still doesn't fit).
 
     TODO:
-        - text overflow
-        - select screen / follow mouse/keyboard focus
-        - critical notifications to replace any visible non-critical notifs immediately?
         - hints: image-path, desktop-entry (for icon)
         - hints: Notifier parameters set for single notification?
-        - hints: progress value e.g. int:value:42 with drawing
 
     """
 
     defaults = [
-        ("x", 32, "x position on screen to start drawing notifications."),
-        ("y", 64, "y position on screen to start drawing notifications."),
+        (
+            "corner",
+            "top_left",
+            "Screen corner to stack notifications from: top_left, top_right, "
+            "bottom_left or bottom_right.",
+        ),
+        ("x", 32, "Horizontal distance of notifications from the corner."),
+        ("y", 64, "Vertical distance of notifications from the corner."),
         ("width", 192, "Width of notifications."),
         ("height", 64, "Height of notifications."),
         ("format", "{summary}\n{body}", "Text format."),
@@ -115,9 +527,42 @@ class Notifier(configurable.Configurable):
             "How to deal with too much text: more_width, more_height, or truncate.",
         ),
         ("max_windows", 2, "Maximum number of windows to show at once."),
+        (
+            "popup_idle_release",
+            60,
+            "Seconds after which unused popup windows are destroyed, or None to keep them.",
+        ),
+        ("rate_limit", 3, "Notifications per second per app_name before coalescing, or None."),
+        ("coalesce_window", 1000, "Milliseconds to collect notifications over the rate limit."),
+        ("coalesce_format", "{count} new from {app_name}", "Summary of coalesced notifications."),
+        ("stack", True, "Stack notifications from the same app_name into one popup."),
+        ("stack_format", "{summary} ({count})", "Summary of stacked notifications."),
         ("gap", 12, "Vertical gap between popup windows."),
         ("sticky_history", True, "Disable timeout when browsing history."),
+        ("hover_pause", True, "Pause a notification's timeout while the mouse is over it."),
+        (
+            "history",
+            True,
+            "Keep the history on disk so it survives restarts: True for the default "
+            "location, a file path, or False to only keep it in memory. When on disk, "
+            "older entries of libqtile's notifier.notifications are set to None, "
+            "which libqtile's own Notify widget doesn't expect.",
+        ),
+        ("history_cache", 32, "Number of history entries kept in memory when on disk."),
+        (
+            "history_size",
+            10000,
+            "Number of history entries kept on disk, or 0 for no limit. The oldest are "
+            "dropped once there are a quarter more than this.",
+        ),
+        ("stats_size", 512, "Number of samples kept for each statistic shown by stats()."),
         ("icon_size", 36, "Pixel size of any icons."),
+        ("progress_height", 4, "Height of the progress bar drawn for the value hint."),
+        ("progress_colour", None, "Colour of the progress bar, or None for foreground."),
+        ("icon_cache_size", 64, "Maximum number of decoded icons kept in memory."),
+        ("icon_cache_bytes", 8 * 1024 * 1024, "Maximum memory used by decoded icons."),
+        ("icon_retry", 60, "Seconds before retrying an icon that failed to load."),
+        ("render_cache_size", 16, "Number of rendered popups kept for repeated notifications."),
         ("fullscreen", "show", "What to do when in fullscreen: show, hide, or queue."),
         ("screen", "focus", "How to select a screen: focus, mouse, or an int."),
         ("actions", True, "Whether to enable the actions capability."),
@@ -129,14 +574,43 @@ class Notifier(configurable.Configurable):
         configurable.Configurable.__init__(self, **config)
         self.add_defaults(Notifier.defaults)
         self._hidden: List[Popup] = []
+        self._popup_config: Dict[str, Any] = {}
+        self._popup_count: int = 0
+        self._by_id: Dict[int, Popup] = {}
+        self._expiry = _Expiry(self._close)
+        self._release_timer: Optional[asyncio.TimerHandle] = None
         self._shown: List[Popup] = []
-        self._queue: List[Notification] = []
-        self._positions: List[Tuple[int, int]] = []
+        self._stats = _Stats(self.stats_size)
+        self._queue = _NotificationQueue(on_wait=self._stats.queued.append)
+        self._app_times: Dict[str, Deque[float]] = {}
+        self._coalescing: Dict[str, List[Notification]] = {}
+        self._anchors: Dict[Tuple[int, int, int, int], Tuple[int, int]] = {}
+        self._fitted = _LRUCache(64)
         self._scroll_popup: Optional[Popup] = None
         self._current_id: int = 0
         self._notif_id: Optional[int] = None
         self._paused: bool = False
-        self._icons: Dict[str, Tuple[ImageSurface, int]] = {}
+        self._ready: Optional[asyncio.Event] = None
+        self._search: Optional[SearchIndex] = None
+        self._last_search: Optional[str] = None
+        self._icons = _LRUCache(
+            self.icon_cache_size, self.icon_cache_bytes, _icon_bytes
+        )
+        self._icon_failures = _LRUCache(self.icon_cache_size)
+        self._icon_loading: Dict[str, asyncio.Future] = {}
+        self._rendered = _LRUCache(self.render_cache_size, sizeof=_surface_bytes)
+        self._render_tokens: Iterator[int] = itertools.count()
+
+        if self.history is False:
+            self._history: Any = notifier.notifications
+        else:
+            self._history = NotificationHistory(
+                None if self.history is True else self.history,
+                self.history_cache,
+                self.history_size,
+            )
+            hook.subscribe.shutdown(self._history.close)
+        self._released: int = 0
 
         self._make_attr_list("foreground")
         self._make_attr_list("background")
@@ -158,20 +632,21 @@ class Notifier(configurable.Configurable):
 
     async def _configure(self) -> None:
         """
-        This method needs to be called to set up the Notifier with the Qtile manager and
-        create the required popup windows.
+        This method needs to be called to set up the Notifier with the Qtile manager.
+        Popup windows are created later, when there is something to show.
         """
         if self.horizontal_padding is None:
             self.horizontal_padding = self.font_size // 2
         if self.vertical_padding is None:
             self.vertical_padding = self.font_size // 2
 
-        popup_config = {
+        popup_config = self._popup_config
+        popup_config.update({
             "x": self.x,
             "y": self.y,
             "width": self.width,
             "height": self.height,
-        }
+        })
 
         for opt in Popup.defaults:
             key = opt[0]
@@ -182,28 +657,77 @@ class Notifier(configurable.Configurable):
                 else:
                     popup_config[key] = value
 
-        for win in range(self.max_windows):
-            popup = Popup(qtile, **popup_config)
-            popup.win.process_button_click = self._process_button_click(popup)
-            popup.notif = None
-            self._hidden.append(popup)
-            self._positions.append(
-                (
-                    self.x,
-                    self.y + win * (self.height + 2 *
-                                    self.border_width + self.gap),
-                )
-            )
+        self._anchors.clear()
+        hook.subscribe.screen_change(self._on_screen_change)
+        # Local notifications don't need to wait for the bus
+        if self._ready is None:
+            self._ready = asyncio.Event()
+        self._ready.set()
 
         # Clear defunct callbacks left when reloading the config
         notifier.callbacks.clear()
         notifier.close_callbacks.clear()
 
-        await notifier.register(
-            self._notify, Notifier.capabilities, on_close=self._on_close
-        )
+        with log_duration("Notifier D-Bus service"):
+            await notifier.register(
+                self._receive, Notifier.capabilities, on_close=self._on_close
+            )
         logger.info("Notification server started up successfully")
 
+    def _acquire_popup(self) -> Optional[Popup]:
+        """
+        Get an unused popup window, creating one if fewer than max_windows exist.
+        """
+        if self._hidden:
+            return self._hidden.pop()
+        if self._popup_count >= self.max_windows:
+            return None
+        popup = Popup(qtile, **self._popup_config)
+        popup.win.process_button_click = self._process_button_click(popup)
+        if self.hover_pause:
+            popup.win.process_pointer_enter = lambda x, y: self._expiry.pause(popup)
+            popup.win.process_pointer_leave = lambda x, y: self._expiry.resume(popup)
+        popup.notif = None
+        popup.stack = []
+        self._popup_count += 1
+        return popup
+
+    def _release_popup(self, popup: Popup) -> None:
+        """
+        Return a popup window to the pool once it has been hidden.
+        """
+        popup.released_at = time.monotonic()
+        self._hidden.append(popup)
+        if self.popup_idle_release is not None and self._release_timer is None:
+            self._release_timer = qtile.call_later(
+                self.popup_idle_release, self._release_idle
+            )
+
+    def _release_idle(self) -> None:
+        """
+        Destroy popups that have not been used for popup_idle_release seconds, keeping
+        one around so that the next notification is quick to show.
+        """
+        self._release_timer = None
+        now = time.monotonic()
+        expired = [
+            popup
+            for popup in self._hidden
+            if now - popup.released_at >= self.popup_idle_release
+        ]
+        if len(expired) == len(self._hidden):
+            # The last one released is the first to be reused
+            expired.pop()
+        for popup in expired:
+            self._hidden.remove(popup)
+            popup.kill()
+            self._popup_count -= 1
+        if len(self._hidden) > 1:
+            oldest = min(popup.released_at for popup in self._hidden)
+            self._release_timer = qtile.call_later(
+                oldest + self.popup_idle_release - now, self._release_idle
+            )
+
     def _process_button_click(self, popup: Popup) -> Callable:
         def _(x: int, y: int, button: int) -> None:
             if button == 1:
@@ -214,13 +738,52 @@ class Notifier(configurable.Configurable):
 
         return _
 
-    def _notify(self, notif: Notification) -> None:
+    def _receive(self, notif: Notification) -> None:
+        """
+        Entry point for new notifications: record them in the history, then show them.
+        """
+        notif.received_at = time.monotonic()
+        self._stats.count("received")
+        self._stats.queue_depth.append(len(self._queue))
+        if self._history is not notifier.notifications:
+            generation = self._history.generation
+            expected = len(self._history) + 1
+            position = self._history.append(notif)
+            self._release_persisted()
+            if self._history.generation != generation:
+                # Compacted, so the oldest entries are gone and the rest renumbered
+                self._search = None
+                if self._notif_id is not None:
+                    dropped = expected - len(self._history)
+                    self._notif_id = max(0, self._notif_id - dropped)
+        else:
+            position = len(self._history) - 1
+        if self._search is not None:
+            self._search.add(position, notif.summary, notif.body, notif.app_name)
+        self._notify(notif)
+
+    def _release_persisted(self) -> None:
+        """
+        Let go of the notifications libqtile keeps in memory once they are on disk,
+        apart from the latest history_cache of them. Their places in the list are
+        kept, as None, because libqtile numbers notifications from its length.
+        """
+        notifications = notifier.notifications
+        end = len(notifications) - self.history_cache
+        for i in range(self._released, end):
+            notifications[i] = None
+        self._released = max(self._released, end)
+
+    def _notify(self, notif: Notification, limit: bool = True) -> None:
         """
         This method is registered with the NotificationManager to handle notifications
         received via dbus. They will either be drawn now or queued to be drawn soon.
         """
+        if limit and self._rate_limited(notif):
+            return
+
         if self._paused:
-            self._queue.append(notif)
+            self._enqueue(notif)
             return
 
         if qtile.current_window and qtile.current_window.fullscreen:
@@ -228,25 +791,219 @@ class Notifier(configurable.Configurable):
                 if self.fullscreen == "queue":
                     if self._unfullscreen not in hook.subscriptions:
                         hook.subscribe.float_change(self._unfullscreen)
-                    self._queue.append(notif)
+                    self._enqueue(notif)
                 return
 
         if notif.replaces_id:
-            for popup in self._shown:
-                if notif.replaces_id == popup.notif.replaces_id:
-                    self._shown.remove(popup)
+            popup = self._by_id.get(notif.replaces_id)
+            if popup is not None and popup in self._shown:
+                # Redrawn where it is, other popups only move if its size changes
+                if len(popup.stack) > 1:
+                    self._show_stack(popup, [
+                        item for item in popup.stack if item.id != notif.replaces_id
+                    ] + [notif])
+                elif _same_apart_from_progress(popup.notif, notif):
+                    self._update_progress(popup, notif)
+                else:
                     self._send(notif, popup)
-                    self._reposition()
+                return
+
+        if self._stackable(notif):
+            for popup in self._shown:
+                if (
+                    popup is not self._scroll_popup
+                    and popup.notif.app_name == notif.app_name
+                    and self._stackable(popup.notif)
+                ):
+                    self._stats.count("stacked")
+                    self._show_stack(popup, popup.stack + [notif])
                     return
 
-        if self._hidden:
-            self._send(notif, self._hidden.pop())
+        popup = self._acquire_popup()
+        if popup is not None:
+            self._send(notif, popup)
+        elif not self._preempt(notif):
+            self._enqueue(notif)
+
+    def _enqueue(self, notif: Notification) -> None:
+        self._queue.push(notif)
+        self._stats.count("queued")
+
+    def _rate_limited(self, notif: Notification) -> bool:
+        """
+        Check the per-application rate limit. Returns True if the notification was
+        held back to be coalesced with others from the same application.
+        """
+        if not self.rate_limit or notif.replaces_id or _urgency(notif) >= 2:
+            return False
+        app = notif.app_name or ""
+        if app in self._coalescing:
+            self._coalescing[app].append(notif)
+            self._stats.count("coalesced")
+            return True
+
+        now = time.monotonic()
+        times = self._app_times.setdefault(app, deque())
+        while times and now - times[0] > 1:
+            times.popleft()
+        if len(times) < self.rate_limit:
+            times.append(now)
+            return False
+
+        self._coalescing[app] = [notif]
+        self._stats.count("coalesced")
+        qtile.call_later(self.coalesce_window / 1000, self._flush_coalesced, app)
+        return True
+
+    def _flush_coalesced(self, app: str) -> None:
+        notifs = self._coalescing.pop(app, [])
+        self._app_times.pop(app, None)
+        if not notifs:
+            return
+        if len(notifs) == 1:
+            self._notify(notifs[0], limit=False)
+            return
+
+        latest = notifs[-1]
+        summary = self.coalesce_format.format(
+            count=len(notifs), app_name=app, summary=latest.summary
+        )
+        self._notify(self._combine(notifs, summary, latest.summary), limit=False)
+
+    def _combine(
+        self, notifs: List[Notification], summary: str, body: str
+    ) -> Notification:
+        """
+        A notification standing in for several from the same app. Closing or
+        clicking it acts on the latest of them.
+        """
+        from libqtile.notify import Notification
+
+        latest = notifs[-1]
+        timeouts = [-1 if n.timeout is None else n.timeout for n in notifs]
+        # The longest asked for, or sticky if any of them is
+        timeout = 0 if 0 in timeouts else max(timeouts)
+        combined = Notification(
+            summary,
+            body,
+            timeout,
+            max(notifs, key=_urgency).hints,
+            latest.app_name or "",
+            None,
+            latest.app_icon,
+            latest.actions,
+        )
+        combined.id = latest.id
+        # Moved rather than copied, so that redrawing a stack doesn't add another
+        # latency sample for the same notification
+        combined.received_at = getattr(latest, "received_at", None)
+        latest.received_at = None
+        return combined
+
+    def _stackable(self, notif: Notification) -> bool:
+        return (
+            self.stack
+            and bool(notif.app_name)
+            and _urgency(notif) < 2
+            and _progress(notif) is None
+        )
+
+    def _show_stack(self, popup: Popup, stack: List[Notification]) -> None:
+        """
+        Show a stack of notifications from one app on a popup, as their count and
+        the latest of them.
+        """
+        latest = stack[-1]
+        if len(stack) == 1:
+            self._send(latest, popup)
+            return
+        summary = self.stack_format.format(
+            count=len(stack), app_name=latest.app_name, summary=latest.summary
+        )
+        self._send(self._combine(stack, summary, latest.body), popup, stack=stack)
+
+    def _show_next(self, popup: Popup) -> None:
+        """
+        Show the next queued notification on a popup that has become free, together
+        with any others from the same app that are waiting.
+        """
+        notif = self._queue.pop()
+        if self._stackable(notif):
+            stack = [notif] + self._queue.take(notif.app_name, self._stackable)
+            self._stats.count("stacked", len(stack) - 1)
+            self._show_stack(popup, stack)
         else:
-            self._queue.append(notif)
+            self._send(notif, popup)
+
+    def _preempt(self, notif: Notification) -> bool:
+        """
+        Show a critical notification in place of the least urgent visible one, which
+        is queued again. Returns False if there is nothing to replace.
+        """
+        urgency = _urgency(notif)
+        if urgency < 2:
+            return False
+        candidates = [
+            popup
+            for popup in self._shown
+            if popup is not self._scroll_popup and _urgency(popup.notif) < urgency
+        ]
+        if not candidates:
+            return False
+        # min() keeps the first, i.e. oldest, of equally urgent popups
+        popup = min(candidates, key=lambda p: _urgency(p.notif))
+        # A stack's notifications go back individually, not as their combination
+        displaced = popup.stack or [popup.notif]
+        self._unset_notif(popup)
+        for item in displaced:
+            self._enqueue(item)
+        self._stats.count("preempted")
+        self._shown.remove(popup)
+        self._send(notif, popup)
+        self._reposition()
+        return True
 
     def _on_close(self, nid: int) -> None:
-        for popup in self._shown:
-            self._close(popup, nid=nid, reason=ClosedReason.method)
+        popup = self._by_id.get(nid)
+        if popup is None:
+            return
+        rest = [item for item in popup.stack if item.id != nid]
+        if rest and popup in self._shown:
+            # Only one of a stack was closed
+            self._show_stack(popup, rest)
+            if notifier._service is not None:
+                notifier._service.NotificationClosed(nid, ClosedReason.method)
+        else:
+            self._close(popup, reason=ClosedReason.method)
+
+    def _set_notif(
+        self,
+        popup: Popup,
+        notif: Notification,
+        stack: Optional[List[Notification]] = None,
+    ) -> None:
+        """
+        Show `notif` on `popup`, standing for the notifications in `stack` if it
+        combines several, as far as the id index is concerned.
+        """
+        self._unset_notif(popup)
+        popup.notif = notif
+        popup.stack = stack or [notif]
+        if popup is self._scroll_popup:
+            # History entries can carry ids from earlier sessions, which now belong
+            # to other notifications
+            return
+        for item in popup.stack:
+            self._by_id[item.id] = popup
+        self._by_id[notif.id] = popup
+
+    def _unset_notif(self, popup: Popup) -> None:
+        for item in popup.stack:
+            if self._by_id.get(item.id) is popup:
+                del self._by_id[item.id]
+        if popup.notif is not None and self._by_id.get(popup.notif.id) is popup:
+            del self._by_id[popup.notif.id]
+        popup.stack = []
 
     def _unfullscreen(self) -> None:
         """
@@ -261,57 +1018,43 @@ class Notifier(configurable.Configurable):
         If we hold off temporarily on sending notifications and accumulate a queue, we
         should use this to send the queue through self._notify again.
         """
-        queue = self._queue.copy()
-        self._queue.clear()
-        while queue:
-            self._notify(queue.pop(0))
+        for notif in self._queue.drain():
+            self._notify(notif, limit=False)
 
     def _send(
-        self, notif: Notification, popup: Popup, timeout: Optional[int] = None
+        self,
+        notif: Notification,
+        popup: Popup,
+        timeout: Optional[int] = None,
+        stack: Optional[List[Notification]] = None,
     ) -> None:
         """
         Draw the desired notification using the specified Popup instance.
         """
-        text = self._get_text(notif)
-
-        if "urgency" in notif.hints:
-            urgency = notif.hints["urgency"].value
-        else:
-            urgency = 1
+        urgency = _urgency(notif)
 
         self._current_id += 1
         popup.id = self._current_id  # Used for closing the popup
-        popup.notif = notif  # Used for finding the visible popup's notif for actions
+        # Used for finding the visible popup's notif for actions and by id
+        self._set_notif(popup, notif, stack)
         if popup not in self._shown:
             self._shown.append(popup)
-        popup.x, popup.y = self._get_coordinates()
-        popup.place()
-        icon = self._load_icon(notif)
-        popup.unhide()
-
-        popup.background = self.background[urgency]
-        popup.foreground = self.foreground[urgency]
-        popup.clear()
-
-        if icon:
-            popup.draw_image(
-                icon[0],
-                self.horizontal_padding,
-                1 + (self.height - icon[1]) / 2,
-            )
-            popup.horizontal_padding += self.icon_size + self.horizontal_padding / 2
+        self._reposition()
+        popup.unpainted = True
+        self._draw(popup, notif, urgency)
+        self._schedule_close(popup, notif, urgency, timeout)
 
-        for num, line in enumerate(text.split("\n")):
-            popup.text = line
-            y = self.vertical_padding + num * \
-                (popup.layout.height + self.line_spacing)
-            popup.draw_text(y=y)
-        if self.border_width:
-            popup.set_border(self.border[urgency])
-        popup.draw()
-        if icon:
-            popup.horizontal_padding = self.horizontal_padding
+    def _painted(self, notif: Notification) -> None:
+        self._stats.count("shown")
+        received_at = getattr(notif, "received_at", None)
+        if received_at is not None:
+            # Only the first paint counts, not browsing the history
+            self._stats.latency.append(time.monotonic() - received_at)
+            notif.received_at = None
 
+    def _schedule_close(
+        self, popup: Popup, notif: Notification, urgency: int, timeout: Optional[int]
+    ) -> None:
         if timeout is None:
             if notif.timeout is None or notif.timeout < 0:
                 timeout = self.timeout[urgency]
@@ -320,37 +1063,282 @@ class Notifier(configurable.Configurable):
         elif timeout < 0:
             timeout = self.timeout[urgency]
         if timeout > 0:
-            qtile.call_later(timeout / 1000, self._close,
-                             popup, self._current_id)
+            self._expiry.schedule(popup, timeout / 1000)
+        else:
+            self._expiry.cancel(popup)
+
+    def _draw(self, popup: Popup, notif: Notification, urgency: int) -> None:
+        """
+        Paint the notification's contents onto the popup. Fitting the text, the
+        layout and drawing are done in an offscreen surface on a worker thread, and
+        the popup is sized and shown once it is ready. Popups identical to one drawn
+        recently reuse its surface.
+        """
+        icon = self._load_icon(notif)
+        screen = self._get_screen()
+        # The size limits depend on the screen, which can differ from one popup to
+        # the next with screen="focus" or "mouse"
+        fit_key = (
+            notif.summary,
+            notif.body,
+            notif.app_name,
+            icon is not None,
+            screen.width,
+            screen.height,
+        )
+        key = fit_key + (urgency, notif.app_icon if icon else None)
+
+        popup.background = self.background[urgency]
+        popup.foreground = self.foreground[urgency]
+        if self.border_width:
+            popup.set_border(self.border[urgency])
+
+        # Also makes any render still running for this popup out of date
+        token = popup.render_token = next(self._render_tokens)
+        surface = self._rendered.get(key)
+        if surface is not None:
+            self._paint(popup, surface)
+            return
+
+        future = qtile.run_in_executor(
+            self._render,
+            notif,
+            urgency,
+            icon,
+            screen.width,
+            screen.height,
+            self._fitted.get(fit_key),
+        )
+        future.add_done_callback(
+            lambda f: self._rendered_cb(popup, token, fit_key, key, f)
+        )
+
+    def _rendered_cb(
+        self,
+        popup: Popup,
+        token: int,
+        fit_key: Tuple,
+        key: Tuple,
+        future: asyncio.Future,
+    ) -> None:
+        if future.cancelled():
+            return
+        try:
+            surface, fitted = future.result()
+        except Exception:
+            logger.exception("Failed to render notification")
+            return
+        self._fitted.put(fit_key, fitted)
+        self._rendered.put(key, surface)
+        # Drop it if the popup has been closed or redrawn in the meantime
+        if popup.render_token == token and popup in self._shown:
+            self._paint(popup, surface)
+
+    def _render(
+        self,
+        notif: Notification,
+        urgency: int,
+        icon: Optional[Tuple[ImageSurface, int]],
+        screen_width: int,
+        screen_height: int,
+        fitted: Optional[Tuple[str, int, int]],
+    ) -> Tuple[ImageSurface, Tuple[str, int, int]]:
+        """
+        Fit, lay out and draw a notification into a new surface the size of its popup,
+        returning the surface and the fitted text and size. `fitted` is a previous
+        fit of the same notification to reuse. This runs on a worker thread, so it
+        only uses cairo and Pango objects of its own.
+        """
+        if fitted is None:
+            fitted = self._fit(notif, icon is not None, screen_width, screen_height)
+        text, width, height = fitted
+        surface = cairocffi.ImageSurface(cairocffi.FORMAT_ARGB32, width, height)
+        ctx = pangocffi.patch_cairo_context(cairocffi.Context(surface))
+        ctx.set_source_rgba(*utils.rgb(self.background[urgency]))
+        ctx.paint()
+
+        x = self.horizontal_padding
+        if icon:
+            ctx.set_source_surface(icon[0], x, 1 + (height - icon[1]) / 2)
+            ctx.paint()
+            x += self._icon_offset(True)
+
+        layout = ctx.create_layout()
+        desc = pangocffi.FontDescription.from_string(self.font)
+        desc.set_absolute_size(pangocffi.units_from_double(float(self.font_size)))
+        layout.set_font_description(desc)
+        layout.set_alignment(pangocffi.ALIGNMENTS[self.text_alignment])
+        layout.set_width(
+            pangocffi.units_from_double(self._text_width(width, icon is not None))
+        )
+
+        passes = [(self.foreground[urgency], 0)]
+        if self.fontshadow:
+            passes.insert(0, (self.fontshadow, 1))
+        y = self.vertical_padding
+        for paragraph in text.split("\n"):
+            attrs, plain, _ = pangocffi.parse_markup(paragraph)
+            layout.set_attributes(attrs)
+            layout.set_text(plain)
+            for colour, offset in passes:
+                ctx.set_source_rgba(*utils.rgb(colour))
+                ctx.move_to(x + offset, y + offset)
+                ctx.show_layout(layout)
+            y += layout.get_pixel_size()[1] + self.line_spacing
+        return surface, fitted
+
+    def _paint(self, popup: Popup, surface: ImageSurface) -> None:
+        """
+        Size the popup to a rendered notification, copy it on and show it.
+        """
+        notif = popup.notif
+        width, height = surface.get_width(), surface.get_height()
+        if (popup.width, popup.height) != (width, height):
+            popup.width = popup.drawer.width = width
+            popup.height = popup.drawer.height = height
+            self._reposition()
+        popup.clear()
+        ctx = popup.drawer.ctx
+        ctx.save()
+        ctx.set_operator(cairocffi.OPERATOR_SOURCE)
+        ctx.set_source_surface(surface)
+        ctx.paint()
+        ctx.restore()
+        # The notification may have had its progress updated while rendering
+        self._paint_progress(popup, notif, _urgency(notif))
+        popup.unhide()
+        popup.draw()
+        if popup.unpainted:
+            popup.unpainted = False
+            self._painted(notif)
+
+    def _progress_rect(self, popup: Popup) -> Tuple[int, int, int, int]:
+        x = self.horizontal_padding
+        y = popup.height - self.vertical_padding // 2 - self.progress_height
+        return x, y, popup.width - 2 * x, self.progress_height
+
+    def _paint_progress(self, popup: Popup, notif: Notification, urgency: int) -> None:
+        value = _progress(notif)
+        if value is None:
+            return
+        x, y, width, height = self._progress_rect(popup)
+        drawer = popup.drawer
+        drawer.set_source_rgb(self.background[urgency])
+        drawer.ctx.rectangle(x, y, width, height)
+        drawer.ctx.fill()
+        drawer.set_source_rgb(self.progress_colour or self.foreground[urgency])
+        drawer.ctx.rectangle(x, y, width * value / 100, height)
+        drawer.ctx.fill()
+
+    def _update_progress(self, popup: Popup, notif: Notification) -> None:
+        """
+        Show a new progress value on a popup by repainting only the bar.
+        """
+        urgency = _urgency(notif)
+        self._current_id += 1
+        popup.id = self._current_id
+        self._set_notif(popup, notif)
+        self._paint_progress(popup, notif, urgency)
+        x, y, width, height = self._progress_rect(popup)
+        popup.drawer.draw(
+            offsetx=x, offsety=y, width=width, height=height, src_x=x, src_y=y
+        )
+        self._schedule_close(popup, notif, urgency, None)
+        self._painted(notif)
 
-    def _get_text(self, notif: Notification) -> str:
+    def _get_text(self, notif: Notification, body: Optional[str] = None) -> str:
         summary = ""
-        body = ""
         app_name = ""
         if notif.summary:
             summary = pangocffi.markup_escape_text(notif.summary)
-        if notif.body:
-            body = "\n".join(
-                wrap(
-                    pangocffi.markup_escape_text(notif.body),
-                    width=33,
-                    max_lines=2,
-                    placeholder="...",
-                )
-            )
+        if body is None:
+            body = notif.body or ""
+        body = pangocffi.markup_escape_text(body) if body else ""
         if notif.app_name:
             app_name = pangocffi.markup_escape_text(notif.app_name)
         return self.format.format(summary=summary, body=body, app_name=app_name)
 
-    def _get_coordinates(self) -> Tuple[int, int]:
-        x, y = self._positions[len(self._shown) - 1]
+    def _icon_offset(self, has_icon: bool) -> float:
+        return self.icon_size + self.horizontal_padding / 2 if has_icon else 0
+
+    def _text_width(self, width: int, has_icon: bool) -> float:
+        return width - 2 * self.horizontal_padding - self._icon_offset(has_icon)
+
+    def _text_height(self, text: str, width: float) -> int:
+        metrics = _text_metrics(self.font, self.font_size)
+        paragraphs = text.split("\n")
+        height = sum(metrics.size(p, width)[1] for p in paragraphs)
+        return height + self.line_spacing * (len(paragraphs) - 1)
+
+    def _fit(
+        self, notif: Notification, has_icon: bool, screen_width: int, screen_height: int
+    ) -> Tuple[str, int, int]:
+        """
+        Work out the text and popup size for a notification according to the overflow
+        option. Returns the (possibly truncated) markup, width and height. This runs
+        on a worker thread from `_render`.
+        """
+        max_width = max(self.width, screen_width - 2 * (self.x + self.border_width))
+        max_height = max(self.height, screen_height - 2 * (self.y + self.border_width))
+        width, height = self.width, self.height
+        text = self._get_text(notif)
+
+        if self.overflow == "more_width":
+            metrics = _text_metrics(self.font, self.font_size)
+            natural = max(metrics.size(p)[0] for p in text.split("\n"))
+            needed = natural + self.width - self._text_width(self.width, has_icon)
+            width = int(min(max(width, needed), max_width))
+
+        text_width = self._text_width(width, has_icon)
+        needed = self._text_height(text, text_width) + 2 * self.vertical_padding
+        if self.overflow == "more_height" and needed > height:
+            height = int(min(needed, max_height))
+
+        if needed > height and notif.body:
+            # Longest body prefix that still fits, found by bisection
+            available = height - 2 * self.vertical_padding
+            low, high = 0, len(notif.body)
+            while low < high:
+                mid = (low + high + 1) // 2
+                candidate = self._get_text(notif, notif.body[:mid].rstrip() + "…")
+                if self._text_height(candidate, text_width) <= available:
+                    low = mid
+                else:
+                    high = mid - 1
+            text = self._get_text(notif, notif.body[:low].rstrip() + "…")
+
+        return text, width, height
+
+    def _get_screen(self) -> Any:
         if isinstance(self.screen, int):
-            screen = qtile.screens[self.screen]
-        elif self.screen == "focus":
-            screen = qtile.current_screen
+            return qtile.screens[self.screen]
         elif self.screen == "mouse":
-            screen = qtile.find_screen(*qtile.mouse_position)
-        return x + screen.x, y + screen.y
+            return qtile.find_screen(*qtile.mouse_position)
+        return qtile.current_screen
+
+    def _screen_anchor(self, screen: Any) -> Tuple[int, int]:
+        """
+        The point on a screen that notifications are stacked from: the outer corner of
+        the first popup. Cached per screen geometry until the screens change.
+        """
+        geometry = (screen.x, screen.y, screen.width, screen.height)
+        anchor = self._anchors.get(geometry)
+        if anchor is None:
+            if self.corner.endswith("right"):
+                x = screen.x + screen.width - self.x
+            else:
+                x = screen.x + self.x
+            if self.corner.startswith("bottom"):
+                y = screen.y + screen.height - self.y
+            else:
+                y = screen.y + self.y
+            anchor = self._anchors[geometry] = (x, y)
+        return anchor
+
+    def _on_screen_change(self, *args) -> None:
+        self._anchors.clear()
+        self._fitted.clear()
+        self._reposition()
 
     def _close(self, popup: Popup, nid: Optional[int] = None, reason=1) -> None:
         """
@@ -359,16 +1347,24 @@ class Notifier(configurable.Configurable):
         if popup in self._shown:
             if nid is not None and popup.id != nid:
                 return
+            # Apps aren't told about history entries being closed
+            closed = [] if popup is self._scroll_popup else popup.stack or [popup.notif]
+            self._unset_notif(popup)
+            self._expiry.cancel(popup)
             self._shown.remove(popup)
             if self._scroll_popup is popup:
                 self._scroll_popup = None
                 self._notif_id = None
+                self._expiry.resume_all()
             popup.hide()
             if self._queue and not self._paused:
-                self._send(self._queue.pop(0), popup)
+                self._show_next(popup)
             else:
-                self._hidden.append(popup)
-            notifier._service.NotificationClosed(popup.notif.id, reason)
+                self._release_popup(popup)
+            # Not registered on the bus, e.g. with only show() used so far
+            if notifier._service is not None:
+                for notif in closed:
+                    notifier._service.NotificationClosed(notif.id, reason)
         self._reposition()
 
     def _act(self, popup: Popup) -> None:
@@ -377,34 +1373,89 @@ class Notifier(configurable.Configurable):
         """
         # Currently this always invokes default action
         # actions = {i: l for i, l in zip(notif.actions[:-1:2], notif.actions[1::2])}
-        if popup.notif.actions:
+        if popup.notif.actions and notifier._service is not None:
             notifier._service.ActionInvoked(
                 popup.notif.id, popup.notif.actions[0])
 
     def _reposition(self) -> None:
-        for index, shown in enumerate(self._shown):
-            shown.x, shown.y = self._positions[index]
-            shown.place()
+        """
+        Stack the shown popups from the anchor corner, moving only those whose place
+        or size changed.
+        """
+        if not self._shown:
+            return
+        x, y = self._screen_anchor(self._get_screen())
+        right = self.corner.endswith("right")
+        bottom = self.corner.startswith("bottom")
+        for shown in self._shown:
+            outer_width = shown.width + 2 * self.border_width
+            outer_height = shown.height + 2 * self.border_width
+            if bottom:
+                y -= outer_height
+                geometry = (x - outer_width if right else x, y)
+                y -= self.gap
+            else:
+                geometry = (x - outer_width if right else x, y)
+                y += outer_height + self.gap
+            geometry += (shown.width, shown.height)
+            if getattr(shown, "placed", None) != geometry:
+                shown.x, shown.y = geometry[:2]
+                shown.place()
+                shown.placed = geometry
 
     def _load_icon(self, notif: Notification) -> Optional[Tuple[ImageSurface, int]]:
-        if not notif.app_icon:
+        """
+        Return the notification's icon if it is already decoded. Otherwise start
+        decoding it in a worker thread; popups showing it are redrawn once it is ready.
+        """
+        path = notif.app_icon
+        if not path:
             return None
-        if notif.app_icon in self._icons:
-            return self._icons.get(notif.app_icon)
+        icon = self._icons.get(path)
+        if icon is not None:
+            return icon
+        retry_at = self._icon_failures.get(path)
+        if retry_at is not None:
+            if time.monotonic() < retry_at:
+                return None
+            self._icon_failures.pop(path)
+        if path not in self._icon_loading:
+            future = qtile.run_in_executor(self._decode_icon, path)
+            started = time.monotonic()
+            future.add_done_callback(lambda f: self._icon_loaded(path, f, started))
+            self._icon_loading[path] = future
+        return None
+
+    def _decode_icon(self, path: str) -> Tuple[ImageSurface, int]:
+        img = images.Img.from_path(path)
+        if img.width > img.height:
+            img.resize(width=self.icon_size)
+        else:
+            img.resize(height=self.icon_size)
+        surface, _ = images._decode_to_image_surface(
+            img.bytes_img, img.width, img.height
+        )
+        return surface, surface.get_height()
+
+    def _icon_loaded(
+        self, path: str, future: asyncio.Future, started: float
+    ) -> None:
+        del self._icon_loading[path]
+        if future.cancelled():
+            return
+        self._stats.icon_load.append(time.monotonic() - started)
         try:
-            img = images.Img.from_path(notif.app_icon)
-            if img.width > img.height:
-                img.resize(width=self.icon_size)
-            else:
-                img.resize(height=self.icon_size)
-            surface, _ = images._decode_to_image_surface(
-                img.bytes_img, img.width, img.height
-            )
-            self._icons[notif.app_icon] = surface, surface.get_height()
-        except (FileNotFoundError, images.LoadingError, IsADirectoryError) as e:
-            logger.exception(e)
-            self._icons[notif.app_icon] = None
-        return self._icons[notif.app_icon]
+            self._icons.put(path, future.result())
+        except Exception:
+            # Whatever went wrong, don't decode it again for every notification
+            logger.exception("Failed to load notification icon %s", path)
+            self._stats.count("icon_failures")
+            self._icon_failures.put(path, time.monotonic() + self.icon_retry)
+            return
+        for popup in self._shown:
+            if popup.notif is not None and popup.notif.app_icon == path:
+                self._draw(popup, popup.notif, _urgency(popup.notif))
+        self._reposition()
 
     def close(self, _qtile=None) -> None:
         """
@@ -425,36 +1476,136 @@ class Notifier(configurable.Configurable):
         """
         Display the previous notification in the history.
         """
-        if notifier.notifications:
+        if self._history:
             if self._scroll_popup is None:
-                if self._hidden:
-                    self._scroll_popup = self._hidden.pop(0)
-                else:
-                    self._scroll_popup = self._shown[0]
-                self._notif_id = len(notifier.notifications)
-            if self._notif_id > 0:
-                self._notif_id -= 1
-            self._send(
-                notifier.notifications[self._notif_id],
-                self._scroll_popup,
-                0 if self.sticky_history else None,
-            )
+                self._browse(len(self._history) - 1)
+            else:
+                self._browse(max(0, self._notif_id - 1))
+
+    def _browse(self, position: int) -> None:
+        """
+        Show the history entry at `position` in the history popup, opening it if needed.
+        """
+        if self._scroll_popup is None:
+            self._scroll_popup = self._acquire_popup() or self._shown[0]
+            # Keep what is on screen while browsing
+            self._expiry.pause_all()
+        self._notif_id = position
+        self._send(
+            self._history[position],
+            self._scroll_popup,
+            0 if self.sticky_history else None,
+        )
 
     def next(self, _qtile=None) -> None:
         """
         Display the next notification in the history.
         """
         if self._scroll_popup:
-            if self._notif_id < len(notifier.notifications) - 1:
+            if self._notif_id < len(self._history) - 1:
                 self._notif_id += 1
             if self._scroll_popup in self._shown:
                 self._shown.remove(self._scroll_popup)
             self._send(
-                notifier.notifications[self._notif_id],
+                self._history[self._notif_id],
                 self._scroll_popup,
                 0 if self.sticky_history else None,
             )
 
+    def search(self, _qtile=None, query: str = "", jump: bool = True) -> List[int]:
+        """
+        Find history entries whose summary, body or app name contain every word of
+        `query`, returning up to 50 of their positions in the history (newest
+        first). With `jump`, the history popup shows the first of them, after which
+        prev and next carry on from there. Repeating the same query while browsing
+        searches on from the entry shown, wrapping round to the newest hit after the
+        oldest. E.g. `lazy.function(notifier.search, query="build failed")`, or
+        through the command graph with a NotifierStats widget.
+
+        The index is built from the stored history on first use, then kept up to date
+        as notifications arrive.
+        """
+        if self._search is None:
+            self._search = SearchIndex()
+            if self._history is notifier.notifications:
+                for n, notif in enumerate(self._history):
+                    self._search.add(n, notif.summary, notif.body, notif.app_name)
+            else:
+                for n, record in self._history.records():
+                    self._search.add(
+                        n, record["summary"], record["body"], record["app_name"]
+                    )
+
+        hits = []
+        if self._scroll_popup is not None and query == self._last_search:
+            hits = self._search.search(query, before=self._notif_id)
+        if not hits:
+            hits = self._search.search(query)
+        if jump and hits:
+            self._browse(hits[0])
+        self._last_search = query
+        return hits
+
+    async def show(
+        self,
+        summary: str,
+        body: str = "",
+        app_name: str = "qtile",
+        urgency: int = 1,
+        timeout: int = -1,
+        value: Optional[int] = None,
+        app_icon: str = "",
+        actions: Optional[List[str]] = None,
+        replaces_id: int = 0,
+    ) -> int:
+        """
+        Show a notification from config code, without a notify-send process or a
+        D-Bus round trip. It goes through the same queue, rendering and history as
+        notifications from other apps, and gets an id from the same sequence, so
+        `replaces_id` works as it does over D-Bus. `value` adds a progress bar.
+        Waits for the Notifier to be set up if qtile is still starting, then
+        returns the notification's id.
+
+        By then the notification is queued or given a popup, but the popup is only
+        painted once a worker thread has rendered it, unless an identical one was
+        rendered recently. That takes a few loop iterations rather than one.
+        """
+        from dbus_next import Variant
+        from libqtile.notify import Notification
+
+        if self._ready is None:
+            self._ready = asyncio.Event()
+        await self._ready.wait()
+
+        hints = {"urgency": Variant("y", urgency)}
+        if value is not None:
+            hints["value"] = Variant("i", value)
+        notif = Notification(
+            summary,
+            body,
+            timeout,
+            hints,
+            app_name,
+            replaces_id or None,
+            app_icon,
+            actions or [],
+        )
+        # As the D-Bus service numbers them
+        notifier.notifications.append(notif)
+        notif.id = len(notifier.notifications)
+        self._receive(notif)
+        return notif.id
+
+    def stats(self, _qtile=None) -> Dict[str, Any]:
+        """
+        Timing percentiles (in ms) and counters for recent notifications, also
+        logged. The Notifier isn't part of qtile's command graph, so to query them
+        from outside qtile add a `NotifierStats` widget.
+        """
+        summary = self._stats.summary()
+        logger.info("Notifier stats: %s", summary)
+        return summary
+
     def pause(self, _qtile=None) -> None:
         """
         Pause display of notifications on screen. Notifications will be queued and
@@ -467,3 +1618,45 @@ class Notifier(configurable.Configurable):
             self._paused = True
             while self._shown:
                 self._close(self._shown[0])
+
+
+class NotifierStats(base.InLoopPollText):
+    """
+    Bar widget that makes a Notifier's statistics and history search available
+    through qtile's command graph, e.g. `qtile cmd-obj -o widget notifierstats -f
+    stats`, and can show some of the statistics. The format placeholders are the counters returned by stats() and
+    waiting, the number of notifications currently queued. By default nothing is
+    shown.
+    """
+
+    defaults = [
+        ("format", "", "Text to show, e.g. '{waiting} waiting'."),
+        ("update_interval", 5, "Seconds between updates of the text."),
+    ]
+
+    def __init__(self, notifier: Notifier, **config) -> None:
+        base.InLoopPollText.__init__(self, **config)
+        self.add_defaults(NotifierStats.defaults)
+        self.notifier = notifier
+
+    def poll(self) -> str:
+        if not self.format:
+            return ""
+        counters = dict(self.notifier._stats.counters)
+        return self.format.format(waiting=len(self.notifier._queue), **counters)
+
+    @expose_command()
+    def stats(self) -> Dict[str, Any]:
+        """
+        Timing percentiles (in ms) and counters for recent notifications.
+        """
+        return self.notifier.stats()
+
+    @expose_command()
+    def search(self, query: str, jump: bool = True) -> List[int]:
+        """
+        Search the history as Notifier.search does, returning the positions of the
+        entries found, e.g. `qtile cmd-obj -o widget notifierstats -f search -a
+        "build failed"`.
+        """
+        return self.notifier.search(query=query, jump=jump)
@@ -0,0 +1,375 @@
+"""
+Notification history kept on disk, so it survives restarts and doesn't grow qtile's
+memory over long sessions.
+
+Notifications are appended as JSON lines to a log file. A second file holds the byte
+offset of every record as a fixed-size integer, so record `n` is found with one seek
+into the index and one into the log. Only the most recently read records are kept in
+memory. Once there are a quarter more than `max_entries` records, the oldest are
+dropped by rewriting both files. Writers take an exclusive lock on a third file, so
+several processes can share a history.
+
+Usage:
+
+    from notification_history import NotificationHistory
+
+    history = NotificationHistory()
+    history.append(notif)
+    last = history[len(history) - 1]
+
+`SearchIndex` maps words to the positions of the entries containing them, so a
+search only looks at entries containing the query's words rather than at the
+whole history.
+"""
+
+from __future__ import annotations
+
+import fcntl
+import json
+import os
+import re
+import shutil
+import struct
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+    try:
+        from libqtile.notify import Notification
+    except ImportError:  # no dbus_next
+        Notification = Any  # type: ignore
+
+_OFFSET = struct.Struct("<Q")
+_WORD = re.compile(r"\w+")
+_TAG = re.compile(r"<[^>]*>")
+
+
+# Histories currently open, by path. Opening one again, e.g. when the config is
+# reloaded, closes the old one so that its files aren't leaked. importlib.reload,
+# which qtile uses to reload the config's modules, reruns this module in its old
+# namespace, so the registry is carried over from there.
+_open: Dict[Path, NotificationHistory] = globals().get("_open", {})
+
+
+def default_path() -> Path:
+    state = os.environ.get("XDG_STATE_HOME") or Path.home() / ".local" / "state"
+    return Path(state) / "qtile" / "notifications.log"
+
+
+class NotificationHistory:
+    """
+    Append-only notification log with an offset index. Supports `len()` and indexing
+    like the list in `libqtile.notify.notifier.notifications`, so the two can be used
+    interchangeably.
+    """
+
+    def __init__(
+        self, path: Optional[Path] = None, cache_size: int = 32, max_entries: int = 10000
+    ) -> None:
+        self.path = Path(path).absolute() if path is not None else default_path()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.path.with_suffix(self.path.suffix + ".idx")
+        self.cache_size = cache_size
+        self.max_entries = max_entries
+        # Incremented whenever the entries are renumbered by compaction
+        self.generation = 0
+        self._cache: OrderedDict[int, Notification] = OrderedDict()
+
+        previous = _open.pop(self.path, None)
+        if previous is not None:
+            previous.close()
+        self._lock = open(self.path.with_suffix(self.path.suffix + ".lock"), "ab")
+        self._log: Any = None
+        self._index: Any = None
+        with self._locked():
+            self._recover()
+            if self._over_limit():
+                self._compact()
+        _open[self.path] = self
+
+    def _compact_paths(self) -> Tuple[Path, Path]:
+        return (
+            self.path.with_suffix(self.path.suffix + ".new"),
+            self.index_path.with_suffix(self.index_path.suffix + ".new"),
+        )
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        """
+        Hold the lock shared with other processes using the same history, with the
+        log and index open and up to date.
+        """
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        try:
+            self._open_files()
+            yield
+        finally:
+            fcntl.flock(self._lock, fcntl.LOCK_UN)
+
+    def _open_files(self) -> None:
+        """
+        Open the log and index, or reopen them if another process has compacted the
+        history since, which replaces both files. Must be called with the lock held.
+        """
+        if self._log is None:
+            self._finish_compaction()
+        else:
+            try:
+                current = os.stat(self.path).st_ino == os.fstat(self._log.fileno()).st_ino
+            except FileNotFoundError:
+                current = False
+            if current:
+                self._count = self._index.seek(0, os.SEEK_END) // _OFFSET.size
+                return
+            self._log.close()
+            self._index.close()
+            self._cache.clear()
+            self.generation += 1
+        self._log = open(self.path, "ab+")
+        self._index = open(self.index_path, "ab+")
+        self._count = self._index.seek(0, os.SEEK_END) // _OFFSET.size
+
+    def _finish_compaction(self) -> None:
+        """
+        Complete or undo a compaction that was interrupted. The new log is renamed
+        into place before the new index, so if only the new index is left the
+        compaction only needs that renaming to finish.
+        """
+        log_path, index_path = self._compact_paths()
+        if log_path.exists():
+            log_path.unlink()
+            if index_path.exists():
+                index_path.unlink()
+        elif index_path.exists():
+            os.replace(index_path, self.index_path)
+
+    def _over_limit(self) -> bool:
+        return bool(self.max_entries) and self._count > self.max_entries * 5 // 4
+
+    def _compact(self) -> None:
+        """
+        Drop all but the newest max_entries records, by writing the rest beside the
+        log and index and renaming them over the old ones. Must be called with the
+        lock held.
+        """
+        first = self._count - self.max_entries
+        start = self._offset(first)
+        log_path, index_path = self._compact_paths()
+        with open(log_path, "wb") as log:
+            self._log.seek(start)
+            shutil.copyfileobj(self._log, log)
+            log.flush()
+            os.fsync(log.fileno())
+        with open(index_path, "wb") as index:
+            self._index.seek(first * _OFFSET.size)
+            offsets = self._index.read(self.max_entries * _OFFSET.size)
+            index.write(
+                b"".join(
+                    _OFFSET.pack(offset - start)
+                    for (offset,) in _OFFSET.iter_unpack(offsets)
+                )
+            )
+            index.flush()
+            os.fsync(index.fileno())
+        os.replace(log_path, self.path)
+        os.replace(index_path, self.index_path)
+        self._open_files()
+
+    def _recover(self) -> None:
+        """
+        Drop an index entry that was only partly written, or that points past the
+        end of the log, and cut the log back to the end of the last complete record,
+        e.g. after a crash in the middle of `append`. Must be called with the lock
+        held, so that another process's `append` isn't mistaken for a torn one.
+        """
+        size = self._index.seek(0, os.SEEK_END)
+        count = size // _OFFSET.size
+        log_size = self._log.seek(0, os.SEEK_END)
+        end = 0
+        while count:
+            offset = self._offset(count - 1)
+            if offset < log_size:
+                self._log.seek(offset)
+                line = self._log.readline()
+                if line.endswith(b"\n"):
+                    end = offset + len(line)
+                    break
+            count -= 1
+        if count * _OFFSET.size != size:
+            self._index.truncate(count * _OFFSET.size)
+        if end != log_size:
+            self._log.truncate(end)
+        self._count = count
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, n: int) -> Notification:
+        if n < 0:
+            n += self._count
+        if not 0 <= n < self._count:
+            raise IndexError("notification history index out of range")
+        notif = self._cache.get(n)
+        if notif is None:
+            notif = self.read(n)
+            self._cache[n] = notif
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(n)
+        return notif
+
+    def _offset(self, n: int) -> int:
+        self._index.seek(n * _OFFSET.size)
+        return _OFFSET.unpack(self._index.read(_OFFSET.size))[0]
+
+    def read_record(self, n: int) -> Dict[str, Any]:
+        """
+        The stored fields of entry `n` as a dict.
+        """
+        self._log.seek(self._offset(n))
+        return json.loads(self._log.readline())
+
+    def read(self, n: int) -> Notification:
+        return _to_notification(self.read_record(n))
+
+    def records(self) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """
+        Every entry's position and stored fields, in order.
+        """
+        for n in range(self._count):
+            yield n, self.read_record(n)
+
+    def append(self, notif: Notification) -> int:
+        """
+        Store a notification, returning its position in the history. This compacts
+        the history if it has grown over the limit, which renumbers the entries and
+        increments `generation`.
+        """
+        line = json.dumps(_to_record(notif), ensure_ascii=False).encode() + b"\n"
+        with self._locked():
+            offset = self._log.seek(0, os.SEEK_END)
+            self._log.write(line)
+            self._log.flush()
+            self._index.seek(0, os.SEEK_END)
+            self._index.write(_OFFSET.pack(offset))
+            self._index.flush()
+            self._count += 1
+            if self._over_limit():
+                self._compact()
+        return self._count - 1
+
+    def close(self) -> None:
+        if _open.get(self.path) is self:
+            del _open[self.path]
+        self._log.close()
+        self._index.close()
+        self._lock.close()
+
+
+def _words(*texts: Optional[str]) -> Set[str]:
+    words: Set[str] = set()
+    for text in texts:
+        if text:
+            words.update(_WORD.findall(_TAG.sub(" ", text).casefold()))
+    return words
+
+
+class SearchIndex:
+    """
+    Inverted index over the summary, body and app_name of history entries. Entries
+    must be added in order of position. Words are matched whole and regardless of
+    case, and markup tags are ignored.
+    """
+
+    def __init__(self) -> None:
+        self._postings: Dict[str, List[int]] = {}
+
+    def add(self, n: int, *texts: Optional[str]) -> None:
+        for word in _words(*texts):
+            postings = self._postings.setdefault(word, [])
+            if not postings or postings[-1] < n:
+                postings.append(n)
+
+    def search(
+        self, query: str, limit: int = 50, before: Optional[int] = None
+    ) -> List[int]:
+        """
+        Positions of up to `limit` entries containing every word in `query`, newest
+        first, starting below position `before` if given.
+
+        The words' position lists are intersected by bisecting each of them for the
+        next position they could all share, so runs of entries that can't match are
+        skipped. The cost depends on how the words' entries interleave, and is at
+        worst a bisection per word for each entry of the rarest word.
+        """
+        words = _words(query)
+        if not words:
+            return []
+        lists = [self._postings.get(word) for word in words]
+        if not all(lists):
+            return []
+        lists.sort(key=len)
+        candidate = lists[0][-1] if before is None else before - 1
+        hits: List[int] = []
+        while candidate >= 0 and len(hits) < limit:
+            for postings in lists:
+                i = bisect_right(postings, candidate) - 1
+                if i < 0:
+                    return hits
+                if postings[i] < candidate:
+                    candidate = postings[i]
+                    break
+            else:
+                hits.append(candidate)
+                candidate -= 1
+        return hits
+
+
+def _hint(notif: Notification, name: str) -> Any:
+    hint = notif.hints.get(name) if notif.hints else None
+    return None if hint is None else hint.value
+
+
+def _to_record(notif: Notification) -> Dict[str, Any]:
+    return {
+        "id": notif.id,
+        "time": time.time(),
+        "app_name": notif.app_name,
+        "app_icon": notif.app_icon,
+        "summary": notif.summary,
+        "body": notif.body,
+        "timeout": notif.timeout,
+        "actions": list(notif.actions or ()),
+        "urgency": _hint(notif, "urgency"),
+        "value": _hint(notif, "value"),
+    }
+
+
+def _to_notification(record: Dict[str, Any]) -> Notification:
+    from dbus_next import Variant
+    from libqtile.notify import Notification
+
+    hints = {}
+    if record.get("urgency") is not None:
+        hints["urgency"] = Variant("y", record["urgency"])
+    if record.get("value") is not None:
+        hints["value"] = Variant("i", record["value"])
+    notif = Notification(
+        record["summary"],
+        record["body"],
+        record["timeout"],
+        hints,
+        record["app_name"],
+        None,
+        record["app_icon"],
+        record["actions"],
+    )
+    notif.id = record["id"]
+    return notif
@@ -0,0 +1,40 @@
+"""
+Helpers to log how long parts of the config take to get going.
+
+Times are measured from when this module is first imported, which happens while the
+config is being loaded, so they also cover `qtile restart`.
+"""
+
+from __future__ import annotations
+
+import time
+from contextlib import contextmanager
+
+from libqtile.log_utils import logger
+
+CONFIG_LOADED = time.monotonic()
+
+
+def since_config_load() -> float:
+    """
+    Seconds since the config started loading.
+    """
+    return time.monotonic() - CONFIG_LOADED
+
+
+@contextmanager
+def log_duration(component: str):
+    """
+    Log how long the body took, and when it finished relative to config load.
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        end = time.monotonic()
+        logger.info(
+            "%s initialised in %.1f ms (%.1f ms after config load)",
+            component,
+            (end - start) * 1000,
+            (end - CONFIG_LOADED) * 1000,
+        )
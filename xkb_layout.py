@@ -0,0 +1,263 @@
+"""
+In-process keyboard layout tracking on qtile's own X connection.
+
+Instead of running `xkblayout-subscribe` (or a forked copy of qtile) to watch the
+keyboard group, this asks the X server to send XKB state notifications to the
+connection qtile already reads from, and hooks into the X11 core's event dispatch so
+every layout switch reaches the subscribers within the same X event dispatch.
+
+qtile has dispatched events in a few ways over the years, and all of them are
+handled: `handle_<EventName>` methods looked up by `_xpoll` (0.17 - 0.18), a single
+`handle_event` method (checked against 0.33), and the `EVENT_TO_HANDLER` table of
+later releases. If none of them can be used, `XkbState` raises RuntimeError and the
+keyboard layout widget falls back to its process backend.
+
+Usage:
+
+    from xkb_layout import XkbState
+
+    xkb = XkbState.get(qtile)
+    xkb.subscribe(lambda group: print(xkb.layouts()[group]))
+"""
+
+from __future__ import annotations
+
+import inspect
+from typing import TYPE_CHECKING
+
+import xcffib
+import xcffib.xkb
+import xcffib.xproto
+from libqtile.log_utils import logger
+
+if TYPE_CHECKING:
+    from typing import Any, Callable, List
+
+    from libqtile.core.manager import Qtile
+
+
+# xkbType of the events we are interested in, as sent in the second byte of every
+# XKB event.
+XKB_NEW_KEYBOARD_NOTIFY = 0
+XKB_STATE_NOTIFY = 2
+XKB_NAMES_NOTIFY = 6
+
+# xcffib registers the XKB events under consecutive event codes, but the server
+# sends all of them with the extension's first event code and tells them apart with
+# `xkbType`. Whatever class the event ends up as, it is dispatched as one of these.
+_EVENT_CLASSES = (xcffib.xkb.NewKeyboardNotifyEvent, xcffib.xkb.StateNotifyEvent)
+_HANDLER_NAMES = ("handle_NewKeyboardNotify", "handle_StateNotify")
+
+
+def _route_through_table(core, handler: Callable) -> bool:
+    """
+    Add the XKB events to the core's EVENT_TO_HANDLER table, matching the form of
+    its existing entries. Returns False if that form isn't recognised.
+    """
+    table = getattr(core, "EVENT_TO_HANDLER", None)
+    if not isinstance(table, dict) or not table:
+        return False
+    key, value = next(iter(table.items()))
+    for event_class, name in zip(_EVENT_CLASSES, _HANDLER_NAMES):
+        if isinstance(key, type):
+            event_key: Any = event_class
+        elif isinstance(key, str):
+            event_key = event_class.__name__
+            if not key.endswith("Event"):
+                event_key = event_key.removesuffix("Event")
+        else:
+            return False
+        if isinstance(value, str):
+            setattr(core, name, handler)
+            table[event_key] = name
+        elif callable(value):
+            # Called either as a function of (core, event) or as a bound method
+            table[event_key] = lambda *args: handler(args[-1])
+        else:
+            return False
+    return True
+
+
+def _dispatches_by_name(core) -> bool:
+    try:
+        return "handle_" in inspect.getsource(type(core)._xpoll)
+    except (AttributeError, OSError, TypeError):
+        return False
+
+
+def _route_events(core, handler: Callable) -> None:
+    """
+    Have qtile's X11 core pass XKB events to `handler`, or raise RuntimeError.
+    """
+    routed = _route_through_table(core, handler)
+    original = getattr(core, "handle_event", None)
+    if callable(original):
+
+        def handle_event(event) -> Any:
+            if isinstance(event, _EVENT_CLASSES):
+                return handler(event)
+            return original(event)
+
+        core.handle_event = handle_event
+        routed = True
+    if not routed and _dispatches_by_name(core):
+        for name in _HANDLER_NAMES:
+            setattr(core, name, handler)
+        routed = True
+    if not routed:
+        raise RuntimeError("Can't route XKB events through this qtile's X11 core")
+
+
+def _event_group(event) -> int:
+    """
+    Read the effective group out of a StateNotify event, whichever class xcffib
+    decoded it as. When it arrives as a NewKeyboardNotifyEvent the group byte
+    (offset 13) lands in `oldMaxKeyCode`.
+    """
+    if isinstance(event, xcffib.xkb.StateNotifyEvent):
+        return event.group
+    return event.oldMaxKeyCode
+
+
+class XkbState:
+    """
+    Shared XKB listener for a qtile X11 core. Use `XkbState.get(qtile)` rather than
+    creating instances directly, so that all widgets share one event selection.
+    """
+
+    def __init__(self, qtile: Qtile) -> None:
+        if qtile.core.name != "x11":
+            raise RuntimeError("XKB layout tracking is only available on X11")
+        self.core = qtile.core
+        self.conn = qtile.core.conn
+        self.xkb = self.conn.conn(xcffib.xkb.key)
+        self._subscribers: List[Callable[[int], Any]] = []
+        self._group: int | None = None
+        self._layouts: List[str] | None = None
+
+        reply = self.xkb.UseExtension(1, 0).reply()
+        if not reply.supported:
+            raise RuntimeError("X server does not support the XKB extension")
+
+        events = (
+            xcffib.xkb.EventType.NewKeyboardNotify
+            | xcffib.xkb.EventType.StateNotify
+            | xcffib.xkb.EventType.NamesNotify
+        )
+        self.xkb.SelectEvents(
+            xcffib.xkb.ID.UseCoreKbd, events, 0, events, 0, 0, {}, is_checked=True
+        ).check()
+
+        _route_events(self.core, self._handle_event)
+
+    @classmethod
+    def get(cls, qtile: Qtile) -> XkbState:
+        """
+        Return the listener attached to qtile's core, creating it on first use.
+        """
+        state = getattr(qtile.core, "_xkb_state", None)
+        if state is None:
+            state = cls(qtile)
+            qtile.core._xkb_state = state
+        return state
+
+    def subscribe(self, callback: Callable[[int], Any]) -> None:
+        """
+        Call `callback(group)` every time the active keyboard group changes.
+        """
+        if callback not in self._subscribers:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback: Callable[[int], Any]) -> None:
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def current_group(self) -> int:
+        """
+        Index of the active keyboard group, queried from the server.
+        """
+        self._group = self.xkb.GetState(xcffib.xkb.ID.UseCoreKbd).reply().group
+        return self._group
+
+    @property
+    def group(self) -> int:
+        """
+        Last known active group, without a round trip when it is already known.
+        """
+        if self._group is None:
+            return self.current_group()
+        return self._group
+
+    def lock_group(self, group: int) -> None:
+        """
+        Switch the active keyboard group, like `xkblayout-state set` does.
+        """
+        self.xkb.LatchLockState(
+            xcffib.xkb.ID.UseCoreKbd, 0, 0, True, group, 0, False, 0
+        )
+        self.conn.conn.flush()
+
+    def layouts(self) -> List[str]:
+        """
+        Layout names as configured with setxkbmap, e.g. ["us", "ru"]. The list is
+        cached until the server reports a keymap or group names change, so the
+        returned object only changes identity when the layouts do.
+        """
+        if self._layouts is None:
+            self._layouts = self._read_layouts()
+        return self._layouts
+
+    def invalidate(self) -> None:
+        """
+        Forget the cached layout names. They are read again on next use, by which time
+        setxkbmap has also updated the root window property they come from.
+        """
+        self._layouts = None
+        self._group = None
+
+    def _read_layouts(self) -> List[str]:
+        root = self.conn.default_screen.root.wid
+        atom = self.conn.atoms["_XKB_RULES_NAMES"]
+        reply = self.conn.conn.core.GetProperty(
+            False, root, atom, xcffib.xproto.GetPropertyType.Any, 0, 1024
+        ).reply()
+        # rules, model, layout, variant, options separated by NULs
+        fields = reply.value.to_string().split("\x00")
+        if len(fields) < 3 or not fields[2]:
+            return []
+        return fields[2].split(",")
+
+    def _handle_event(self, event) -> None:
+        if event.xkbType in (XKB_NEW_KEYBOARD_NOTIFY, XKB_NAMES_NOTIFY):
+            self._keymap_changed()
+            return
+        if event.xkbType != XKB_STATE_NOTIFY:
+            return
+        group = _event_group(event)
+        if group == self._group:
+            # a modifier changed, not the layout
+            return
+        self._group = group
+        self._notify(group)
+
+    def _keymap_changed(self) -> None:
+        """
+        Re-read the layouts and active group after a keymap change, and let the
+        subscribers know even if the group index stayed the same, since the layout
+        it stands for may not have.
+        """
+        self.invalidate()
+        try:
+            self._layouts = self._read_layouts()
+            group = self.current_group()
+        except Exception:
+            logger.exception("Couldn't read the new keyboard layouts")
+            return
+        self._notify(group)
+
+    def _notify(self, group: int) -> None:
+        for callback in self._subscribers:
+            try:
+                callback(group)
+            except Exception:
+                logger.exception("XKB layout subscriber %s failed", callback)